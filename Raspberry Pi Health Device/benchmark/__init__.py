@@ -0,0 +1,12 @@
+"""
+Host-side benchmarks for the measurement pipeline.
+
+Runs Measure.adc_get -> operate -> bpm_estimator -> local_hrv on CPython with
+stand-ins for machine, rp2, ssd1306, network and friends, fed from a
+Filefifo capture. Run from the device folder:
+
+    python -m benchmark [capture] [--beats N] [--bpm BPM]
+
+Without a capture a synthetic 250 Hz pulse capture with known RR intervals
+is generated. Needs CPython 3.12+ (the device code uses its f-string syntax).
+"""
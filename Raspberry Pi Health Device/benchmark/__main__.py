@@ -0,0 +1,158 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from benchmark import host
+
+host.install()
+
+from benchmark import synth  # noqa: E402
+from filefifo import Filefifo  # noqa: E402
+from operations import Measure  # noqa: E402
+
+
+# Counts the samples that the pipeline reads from the capture
+class CountingFilefifo(Filefifo):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = 0
+
+    def get_into(self, buf):
+        count = super().get_into(buf)
+        self.count += count
+        return count
+
+
+# One pass over the capture, returns the collected measures
+def run_pipeline(capture, beats, dual_core=False):
+    measure = Measure()
+    measure.dual_core = dual_core
+    measure.test_mode = True
+    measure.measure_test_files = CountingFilefifo(size=100, name=capture, repeat=False)
+    measure.bpm_estimator.reset()
+    measure.start_sampling()
+
+    intervals = []
+    bpms = []
+    start = time.perf_counter()
+    while len(intervals) < beats:
+        interval = measure.operate()
+        # Capture ran out
+        if interval == -1.0:
+            break
+        intervals.append(interval)
+        bpm = measure.bpm_estimator.update(interval)
+        if bpm:
+            bpms.append(bpm)
+    rr_list = [int(interval * 1000) for interval in intervals[1:]]
+    hrv = measure.local_hrv(rr_list) if len(rr_list) > 1 else None
+    elapsed = time.perf_counter() - start
+    measure.stop_sampling()
+
+    return {
+        "elapsed": elapsed,
+        "samples": measure.measure_test_files.count,
+        "beats": len(intervals),
+        "rr": rr_list,
+        "bpm": bpms,
+        "hrv": hrv,
+        "shows": measure.oled.shows,
+        "flushes": measure.renderer.flushes,
+        "i2c_bytes": measure.i2c.bytes_written,
+    }
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+# Same formulas as the device, straight from the known intervals
+def reference_hrv(rr_list):
+    mean_rr = mean(rr_list)
+    diffs = [(rr_list[x + 1] - rr_list[x]) ** 2 for x in range(len(rr_list) - 1)]
+    rmssd = mean(diffs) ** 0.5
+    sdnn = mean([(rr - mean_rr) ** 2 for rr in rr_list]) ** 0.5
+    return rmssd, sdnn
+
+
+def report(result, peak, expected_rr):
+    print("samples read      %d" % result["samples"])
+    print("beats detected    %d" % result["beats"])
+    print("samples/sec       %.0f" % (result["samples"] / result["elapsed"]))
+    if result["beats"]:
+        print("us per beat       %.1f" % (result["elapsed"] / result["beats"] * 1e6))
+    print("oled.show calls   %d" % result["shows"])
+    print("renderer flushes  %d" % result["flushes"])
+    print("i2c bytes         %d" % result["i2c_bytes"])
+    print("peak heap         %.1f KiB" % (peak / 1024))
+
+    if result["hrv"]:
+        analysis = result["hrv"]["analysis"]
+        print("mean RR           %.1f ms" % analysis["mean_rr_ms"])
+        print("mean HR           %.1f bpm" % analysis["mean_hr_bpm"])
+        print("RMSSD             %.1f ms" % analysis["rmssd_ms"])
+        print("SDNN              %.1f ms" % analysis["sdnn_ms"])
+        print("pNN50             %.1f %%" % analysis["pnn50_prc"])
+        print("SD1 / SD2         %.1f / %.1f ms" % (analysis["sd1_ms"], analysis["sd2_ms"]))
+        print("stress index      %.1f" % analysis["stress_index"])
+        freq_domain = analysis["freq_domain"]
+        print(
+            "LF / HF power     %.1f / %.1f ms^2"
+            % (freq_domain["LF_power"], freq_domain["HF_power"])
+        )
+    if result["bpm"]:
+        print("displayed BPM     %.1f (last %d)" % (mean(result["bpm"]), result["bpm"][-1]))
+
+    if expected_rr:
+        expected_mean = mean(expected_rr)
+        print("expected mean RR  %.1f ms (%.1f bpm)" % (expected_mean, 60000 / expected_mean))
+        rmssd, sdnn = reference_hrv(expected_rr)
+        print("expected RMSSD    %.1f ms" % rmssd)
+        print("expected SDNN     %.1f ms" % sdnn)
+        if result["rr"]:
+            error = mean(result["rr"]) - expected_mean
+            print("mean RR error     %+.1f ms" % error)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark")
+    parser.add_argument("capture", nargs="?", help="Filefifo capture, synthetic if left out")
+    parser.add_argument("--beats", type=int, default=60, help="Beats to detect")
+    parser.add_argument("--bpm", type=float, default=72, help="Synthetic capture heart rate")
+    parser.add_argument(
+        "--dual", action="store_true", help="Detect beats on a second thread"
+    )
+    parser.add_argument(
+        "--rate", type=int, default=0, help="Synthetic binary capture at this ADC rate"
+    )
+    args = parser.parse_args()
+
+    expected_rr = None
+    capture = args.capture
+    if capture is None:
+        handle, capture = tempfile.mkstemp(suffix=".bin" if args.rate else ".txt")
+        os.close(handle)
+        if args.rate:
+            expected_rr = synth.rr_series(args.bpm, args.beats + 10, args.rate)
+            synth.write_binary_capture(capture, expected_rr, args.rate)
+        else:
+            expected_rr = synth.rr_series(args.bpm, args.beats + 10)
+            synth.write_capture(capture, expected_rr)
+
+    try:
+        # Timing pass, then a second pass for the heap as tracing slows things down
+        result = run_pipeline(capture, args.beats, args.dual)
+        tracemalloc.start()
+        run_pipeline(capture, args.beats, args.dual)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        if args.capture is None:
+            os.remove(capture)
+
+    report(result, peak, expected_rr)
+
+
+main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEVICE = os.path.dirname(HERE)
+
+_TICKS_PERIOD = 1 << 30
+
+
+def _ticks_ms():
+    return int(time.perf_counter() * 1000) % _TICKS_PERIOD
+
+
+def _ticks_us():
+    return int(time.perf_counter() * 1000000) % _TICKS_PERIOD
+
+
+def _ticks_add(ticks, delta):
+    return (ticks + delta) % _TICKS_PERIOD
+
+
+def _ticks_diff(ticks1, ticks2):
+    diff = (ticks1 - ticks2) % _TICKS_PERIOD
+    return diff - _TICKS_PERIOD if diff >= _TICKS_PERIOD // 2 else diff
+
+
+def _sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+
+def _sleep_us(us):
+    time.sleep(us / 1000000)
+
+
+# Make the device code importable on the host, call before importing it
+def install():
+    for path in (os.path.join(HERE, "stubs"), os.path.join(DEVICE, "pico-lib"), DEVICE):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    # MicroPython's time extensions
+    time.ticks_ms = _ticks_ms
+    time.ticks_us = _ticks_us
+    time.ticks_add = _ticks_add
+    time.ticks_diff = _ticks_diff
+    time.sleep_ms = _sleep_ms
+    time.sleep_us = _sleep_us
@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmark import host
+
+host.install()
+
+
+# Stand-in for the Kubios token and analyze endpoints, the analysis is computed
+# from the posted intervals. Delay slows every response down, in seconds.
+# Missing names a key that is left out of the token and analysis responses,
+# a status other than 0 is the answer to every analysis
+class KubiosStub(BaseHTTPRequestHandler):
+    token = ""
+    tokens_issued = 0
+    analyses = 0
+    delay = 0.0
+    missing = ""
+    status = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        body.pop(KubiosStub.missing, None)
+        body.get("analysis", {}).pop(KubiosStub.missing, None)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        time.sleep(KubiosStub.delay)
+
+        if self.path.endswith("/oauth2/token"):
+            KubiosStub.tokens_issued += 1
+            KubiosStub.token = "token-%d" % KubiosStub.tokens_issued
+            self.reply(200, {"access_token": KubiosStub.token, "expires_in": 3600})
+        elif self.path.endswith("/analytics/analyze"):
+            if self.headers.get("Authorization") != "Bearer " + KubiosStub.token:
+                self.reply(401, {"status": "error"})
+                return
+            if KubiosStub.status:
+                self.reply(KubiosStub.status, {"status": "error"})
+                return
+            KubiosStub.analyses += 1
+            self.reply(200, analysis(json.loads(body)["data"]))
+        else:
+            self.reply(404, {"status": "error"})
+
+
+def analysis(rr_list):
+    mean_rr = sum(rr_list) / len(rr_list)
+    diffs = [(rr_list[x + 1] - rr_list[x]) ** 2 for x in range(len(rr_list) - 1)]
+    deviations = [(rr - mean_rr) ** 2 for rr in rr_list]
+    return {
+        "status": "ok",
+        "analysis": {
+            "create_timestamp": time.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            "mean_rr_ms": mean_rr,
+            "mean_hr_bpm": 60000 / mean_rr,
+            "rmssd_ms": (sum(diffs) / len(diffs)) ** 0.5,
+            "sdnn_ms": (sum(deviations) / len(deviations)) ** 0.5,
+            "pns_index": 0.0,
+            "sns_index": 0.0,
+            "stress_index": 10.0,
+            "readiness": 60.0,
+        },
+    }
+
+
+# Cancelled and timed out requests leave the client gone, that's expected here
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass
+
+
+def serve(port=0):
+    server = QuietServer(("127.0.0.1", port), KubiosStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# The asyncio upload flow against the stand-in: the new dataset ahead of the
+# backlog, token reuse, a revoked token, a request timeout, responses with
+# missing keys, a knob press cancelling an upload, the background uploads of
+# the idle menus and datasets that are set aside
+def check():
+    from kubios_async import AsyncKubios, UploadRejected, asyncio
+
+    server = serve()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+
+    kubios = AsyncKubios()
+    kubios.TOKEN_URL = url + "/oauth2/token"
+    kubios.ANALYZE_URL = url + "/v2/analytics/analyze"
+    kubios.wlan.isconnected = lambda: True
+
+    def upload(intervals):
+        coroutine = kubios.upload_async(intervals)
+        try:
+            return asyncio.run(kubios.run_cancellable(coroutine, "Uploading"))
+        except UploadRejected:
+            return "rejected"
+
+    kubios.upload_queue.add([800] * 30)
+    kubios.upload_queue.add([750] * 30)
+    response = upload([820] * 30)
+    pending = kubios.upload_queue.pending()
+    mean_rr = response["analysis"]["mean_rr_ms"]
+    print("new analysis      mean rr %.0f ms, queue %d" % (mean_rr, pending))
+    results = [kubios.upload_next() for x in range(pending)]
+    pending = kubios.upload_queue.pending()
+    print("backlog uploaded  %d results, queue %d" % (len(results), pending))
+    print("tokens / analyses %d / %d" % (KubiosStub.tokens_issued, KubiosStub.analyses))
+
+    KubiosStub.token = "revoked"
+    response = upload([900] * 30)
+    tokens = KubiosStub.tokens_issued
+    print("after a 401       %s, tokens %d" % (response is not None, tokens))
+
+    kubios.HTTP_TIMEOUT = 0.2
+    KubiosStub.delay = 0.5
+    start = time.perf_counter()
+    response = upload([900] * 30)
+    print("timeout           %s after %.2f s" % (response, time.perf_counter() - start))
+
+    KubiosStub.delay = 0.0
+    for key in ("readiness", "access_token"):
+        KubiosStub.missing = key
+        kubios.token_cache.clear()
+        response = upload([900] * 30)
+        print("%-17s %s" % ("no " + key, response))
+    KubiosStub.missing = ""
+
+    kubios.HTTP_TIMEOUT = 15
+    KubiosStub.delay = 0.5
+    threading.Timer(0.2, kubios.btn_fifo.put, (1,)).start()
+    start = time.perf_counter()
+    response = upload([900] * 30)
+    print("knob cancel       %s after %.2f s" % (response, time.perf_counter() - start))
+
+    # Background uploads from the idle menus, a knob turn stops one and stays
+    # in the fifo for the menus
+    kubios.upload_queue.add([800] * 30)
+    KubiosStub.delay = 0.5
+    threading.Timer(0.1, kubios.rot_fifo.put, (1,)).start()
+    response = kubios.upload_next()
+    turned = kubios.rot_fifo.has_data()
+    print("background turn   %r, turn kept %s" % (response, turned))
+    KubiosStub.delay = 0.0
+    kubios.rot_fifo.get()
+    response = kubios.upload_next()
+    pending = kubios.upload_queue.pending()
+    print("background upload %s, queue %d" % (response != "", pending))
+
+    # A refused dataset is set aside at once, one that keeps failing after
+    # UPLOAD_ATTEMPTS tries. The one behind it goes out after that
+    for status in (400, 503):
+        kubios.upload_queue.add([800] * 30)
+        kubios.upload_queue.add([810] * 30)
+        KubiosStub.status = status
+        tries = 0
+        while kubios.upload_queue.pending() == 2:
+            kubios.upload_next()
+            tries += 1
+        KubiosStub.status = 0
+        response = kubios.upload_next()
+        label = "status %d" % status
+        sent = response != ""
+        print("%-17s set aside after %d, next %s" % (label, tries, sent))
+    with open(kubios.UPLOAD_REJECTED_FILE) as file:
+        print("set aside         %d datasets" % len(file.readlines()))
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark.kubios_stub")
+    parser.add_argument("--port", type=int, default=8080, help="Port to serve on")
+    parser.add_argument(
+        "--check", action="store_true", help="Run the upload flow against it"
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        check()
+        return
+    server = serve(args.port)
+    print("Kubios stand-in on http://127.0.0.1:%d" % server.server_address[1])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
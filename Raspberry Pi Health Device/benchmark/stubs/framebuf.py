@@ -0,0 +1,79 @@
+# Host stand-in for MicroPython's framebuf, MONO_VLSB only and no font
+
+MONO_VLSB = 0
+
+
+class FrameBuffer:
+    def __init__(self, buffer, width, height, format=MONO_VLSB, stride=None):
+        self.buffer = buffer
+        self.width = width
+        self.height = height
+
+    def fill(self, c):
+        value = 0xFF if c else 0
+        for i in range(len(self.buffer)):
+            self.buffer[i] = value
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        index = (y >> 3) * self.width + x
+        bit = 1 << (y & 7)
+        if c is None:
+            return 1 if self.buffer[index] & bit else 0
+        if c:
+            self.buffer[index] |= bit
+        else:
+            self.buffer[index] &= ~bit & 0xFF
+
+    def hline(self, x, y, w, c):
+        for i in range(x, x + w):
+            self.pixel(i, y, c)
+
+    def vline(self, x, y, h, c):
+        for i in range(y, y + h):
+            self.pixel(x, i, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            self.fill_rect(x, y, w, h, c)
+            return
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def fill_rect(self, x, y, w, h, c):
+        for i in range(y, y + h):
+            self.hline(x, i, w, c)
+
+    def line(self, x1, y1, x2, y2, c):
+        dx = abs(x2 - x1)
+        dy = -abs(y2 - y1)
+        sx = 1 if x1 < x2 else -1
+        sy = 1 if y1 < y2 else -1
+        err = dx + dy
+        while True:
+            self.pixel(x1, y1, c)
+            if x1 == x2 and y1 == y2:
+                return
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x1 += sx
+            if e2 <= dx:
+                err += dx
+                y1 += sy
+
+    def text(self, s, x, y, c=1):
+        pass
+
+    def blit(self, fbuf, x, y, key=-1, palette=None):
+        for j in range(fbuf.height):
+            for i in range(fbuf.width):
+                c = fbuf.pixel(i, j)
+                if c != key:
+                    self.pixel(x + i, y + j, c)
+
+    def scroll(self, xstep, ystep):
+        pass
@@ -0,0 +1,54 @@
+# Host stand-in for MicroPython's machine module
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 4
+    IRQ_FALLING = 8
+
+    def __init__(self, id, mode=IN, pull=None, value=None):
+        self.id = id
+        self._value = value or 0
+
+    def irq(self, handler=None, trigger=IRQ_RISING, hard=False):
+        self.handler = handler
+
+    def value(self, *args):
+        if args:
+            self._value = args[0]
+        return self._value
+
+    def __call__(self, *args):
+        return self.value(*args)
+
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read_u16(self):
+        return 0
+
+
+class I2C:
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.id = id
+        self.bytes_written = 0
+
+    def writeto(self, addr, buf):
+        self.bytes_written += len(buf)
+
+    def writevto(self, addr, vector):
+        for buf in vector:
+            self.bytes_written += len(buf)
+
+
+def idle():
+    pass
+
+
+def lightsleep(ms=None):
+    pass
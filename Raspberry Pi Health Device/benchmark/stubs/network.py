@@ -0,0 +1,29 @@
+# Host stand-in for MicroPython's network module, never connects
+
+STA_IF = 0
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+
+    def active(self, *args):
+        if args:
+            self._active = args[0]
+        return self._active
+
+    def connect(self, ssid=None, key=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def isconnected(self):
+        return False
+
+    def status(self):
+        return STAT_IDLE
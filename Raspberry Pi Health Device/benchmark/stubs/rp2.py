@@ -0,0 +1,22 @@
+# Host stand-in for MicroPython's rp2 module, PIO programs never run
+
+
+def asm_pio(**kwargs):
+    def decorator(program):
+        return program
+
+    return decorator
+
+
+class StateMachine:
+    def __init__(self, id, program=None, freq=None):
+        self.id = id
+
+    def irq(self, handler=None, hard=False):
+        self.handler = handler
+
+    def put(self, value):
+        pass
+
+    def active(self, value=None):
+        pass
@@ -0,0 +1,46 @@
+# Host stand-in for the SSD1306 OLED driver, I2C traffic goes to the I2C stand-in
+import framebuf
+
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+
+class SSD1306_I2C(framebuf.FrameBuffer):
+    def __init__(self, width, height, i2c, addr=0x3C, external_vcc=False):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.i2c = i2c
+        self.addr = addr
+        self.temp = bytearray(2)
+        self.write_list = [b"\x40", None]
+        self.buffer = bytearray(self.pages * width)
+        self.shows = 0
+        super().__init__(self.buffer, width, height, framebuf.MONO_VLSB)
+
+    def write_cmd(self, cmd):
+        self.temp[0] = 0x80
+        self.temp[1] = cmd
+        self.i2c.writeto(self.addr, self.temp)
+
+    def write_data(self, buf):
+        self.write_list[1] = buf
+        self.i2c.writevto(self.addr, self.write_list)
+
+    def show(self):
+        self.shows += 1
+        for cmd in (SET_COL_ADDR, 0, self.width - 1, SET_PAGE_ADDR, 0, self.pages - 1):
+            self.write_cmd(cmd)
+        self.write_data(self.buffer)
+
+    def poweroff(self):
+        pass
+
+    def poweron(self):
+        pass
+
+    def contrast(self, contrast):
+        pass
+
+    def invert(self, invert):
+        pass
@@ -0,0 +1,43 @@
+import array
+import math
+import random
+import struct
+
+from filefifo import CAPTURE_HEADER, CAPTURE_MAGIC
+
+
+# Known RR intervals in ms, a breathing-like sway around the mean
+def rr_series(bpm, beats, rate=250, sway_ms=40):
+    mean_rr = 60000 / bpm
+    output = []
+    for k in range(beats):
+        rr = mean_rr + sway_ms * math.sin(2 * math.pi * k / 5)
+        # Whole samples only, so the expected values are exact
+        samples = round(rr * rate / 1000)
+        output.append(samples * 1000 // rate)
+    return output
+
+
+# Samples of a pulse wave with the given RR intervals
+def pulse_wave(rr_list, rate=250, base=32000, amplitude=8000, noise=150, seed=1):
+    rng = random.Random(seed)
+    for rr in rr_list:
+        samples = rr * rate // 1000
+        for i in range(samples):
+            phase = 2 * math.pi * i / samples
+            value = base + amplitude * (math.sin(phase) + 0.3 * math.sin(2 * phase))
+            yield int(value) + rng.randint(-noise, noise)
+
+
+# Write a text capture (one value per line), text captures are at the device SAMPLE_RATE
+def write_capture(name, rr_list, rate=250):
+    with open(name, "w") as file:
+        for value in pulse_wave(rr_list, rate):
+            file.write("%d\n" % value)
+
+
+# Write a binary capture, it carries its own rate so the device decimates it
+def write_binary_capture(name, rr_list, rate):
+    with open(name, "wb") as file:
+        file.write(struct.pack(CAPTURE_HEADER, CAPTURE_MAGIC, rate, 0))
+        file.write(array.array("H", pulse_wave(rr_list, rate)).tobytes())
@@ -0,0 +1,64 @@
+from filefifo import CAPTURE_MAGIC, CAPTURE_HEADER
+import array
+import struct
+import time
+
+
+# Records raw ADC values to flash in fixed-size binary blocks, Filefifo reads them back.
+# When the flash fills up the recording ends there, the measurement goes on
+class CaptureWriter:
+    def __init__(self, name, rate, block_size=256) -> None:
+        """
+        Name: File to write, overwritten if it exists
+        Rate: Sample rate of the recorded values, stored in the header
+        Block_size: Values are collected into a block and written once it's full
+        """
+        self.block = array.array("H", [0] * block_size)
+        self.block_view = memoryview(self.block)
+        self.block_size = block_size
+        self.count = 0
+        # None once the recording has ended
+        self.file = None
+        try:
+            self.file = open(name, "wb")
+            self.file.write(
+                struct.pack(CAPTURE_HEADER, CAPTURE_MAGIC, rate, time.ticks_ms())
+            )
+        except OSError:
+            self.stop()
+
+    # Add one value, the block is written to flash once it's full
+    def put(self, value):
+        if self.file is None:
+            return
+        self.block[self.count] = value
+        self.count += 1
+        if self.count >= self.block_size:
+            self.count = 0
+            try:
+                self.file.write(self.block)
+            except OSError:
+                self.stop()
+
+    # The flash is full or can't be written, keep what made it to the file
+    def stop(self):
+        print("Recording stopped, the flash is full")
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+    # Write what's left in the block and close the file
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            if self.count > 0:
+                self.file.write(self.block_view[0 : self.count])
+                self.count = 0
+            self.file.close()
+            self.file = None
+        except OSError:
+            self.stop()
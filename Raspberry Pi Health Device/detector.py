@@ -0,0 +1,70 @@
+# Streaming beat detector, every sample goes through .update() exactly once
+class BeatDetector:
+    # Slope states
+    WAITING = 0  # Waiting for the signal to rise above the threshold
+    RISING = 1  # Went above the threshold, waiting for the downslope
+    FALLING = 2  # Went below the threshold, the next upslope is a beat
+
+    def __init__(self) -> None:
+        """
+        Index: Sample index of the latest sample, the "clock" of the beat events
+        Last_beat: Sample index of the previous beat, -1 if there's none yet
+        Interval: Samples between the two latest beats, 0 if there's only one
+        Since: Sample index of the latest beat or reset, for timeouts
+        """
+        self.state = self.WAITING
+        self.previous = 0
+        self.index = 0
+        self.last_beat = -1
+        self.interval = 0
+        self.since = 0
+
+    # Start over, e.g. when the signal is lost or a new measurement begins
+    def reset(self):
+        self.state = self.WAITING
+        self.last_beat = -1
+        self.interval = 0
+        self.since = self.index
+
+    """
+    Feed one sample and its sample index, returns the sample index of a beat or -1.
+    The index comes from the sampling clock, so skipped samples still count
+    towards the interval. The slope is checked between every pair of
+    consecutive samples, the state is kept between calls.
+    """
+
+    def update(self, value, threshold, index):
+        previous = self.previous
+        self.previous = value
+        self.index = index
+        state = self.state
+
+        # Going up, both values are above threshold
+        #      /
+        # ------------
+        #   /
+        if state == self.WAITING:
+            if previous < value and threshold < previous:
+                self.state = self.RISING
+
+        # Going down, next value is smaller and both are below threshold
+        #   \
+        # ------------
+        #    \
+        elif state == self.RISING:
+            if value < previous and previous < threshold - threshold // 20:
+                self.state = self.FALLING
+
+        # Going up, and reaching the threshold
+        #      /
+        # ------------
+        #   /
+        elif previous < value and threshold < value:
+            # Already above the threshold, wait for the next downslope
+            self.state = self.RISING
+            self.interval = index - self.last_beat if self.last_beat >= 0 else 0
+            self.last_beat = index
+            self.since = index
+            return index
+
+        return -1
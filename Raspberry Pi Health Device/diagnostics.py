@@ -0,0 +1,52 @@
+import array
+import time
+
+# Profiled stages of the measurement loop
+ADC_GET = 0
+DETECT = 1
+ECG_DRAW = 2
+OLED_SHOW = 3
+STAGE_NAMES = ("adc", "detect", "ecg", "show")
+
+
+# Call counts and ticks_us totals per stage, plus recalibration counts
+class Stats:
+    def __init__(self) -> None:
+        self.calls = array.array("L", [0] * len(STAGE_NAMES))
+        self.times = array.array("L", [0] * len(STAGE_NAMES))
+        # "Missed a beat!" and "Readjusting" recalibrations
+        self.missed_beats = 0
+        self.readjusts = 0
+
+    # Add one call of a stage that started at ticks_us() == start
+    def add(self, stage, start):
+        self.calls[stage] += 1
+        self.times[stage] += time.ticks_diff(time.ticks_us(), start)
+
+    def reset(self):
+        for x in range(len(STAGE_NAMES)):
+            self.calls[x] = 0
+            self.times[x] = 0
+        self.missed_beats = 0
+        self.readjusts = 0
+
+    # Average microseconds per call of a stage
+    def average(self, stage):
+        calls = self.calls[stage]
+        return self.times[stage] // calls if calls else 0
+
+    # Everything on one line for the serial console, jitter of the sampling ISR in us
+    def line(self, fifo, jitter=0):
+        output = ""
+        for x in range(len(STAGE_NAMES)):
+            output += "{} {}x{}us ".format(
+                STAGE_NAMES[x], self.calls[x], self.average(x)
+            )
+        return output + "drop {} max {}/{} jitter {}us miss {} readj {}".format(
+            fifo.dropped(),
+            fifo.high_water(),
+            fifo.size - 1,
+            jitter,
+            self.missed_beats,
+            self.readjusts,
+        )
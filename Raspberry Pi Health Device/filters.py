@@ -0,0 +1,333 @@
+import array
+
+
+# Moving average with a running sum, the cost per value doesn't depend on the window
+class MovingAverage:
+    def __init__(self, size) -> None:
+        """
+        Size: The amount of latest values the average is taken over
+        Values: Preallocated ring of the latest values, oldest gets overwritten
+        Total: Running sum of everything currently in the ring
+        """
+        self.size = size
+        self.values = array.array("l", [0] * size)
+        self.index = 0
+        self.count = 0
+        self.total = 0
+
+    # Add a value and return the average of the window, no allocations
+    def add(self, value):
+        index = self.index
+        # Swap the oldest value out of the sum and the new one in
+        self.total += value - self.values[index]
+        self.values[index] = value
+
+        index += 1
+        if index >= self.size:
+            index = 0
+        self.index = index
+
+        # Until the window fills up, average over what has been received
+        if self.count < self.size:
+            self.count += 1
+
+        return self.total // self.count
+
+    # Forget every value, e.g. between measurements
+    def reset(self):
+        for x in range(self.size):
+            self.values[x] = 0
+        self.index = 0
+        self.count = 0
+        self.total = 0
+
+
+# Flags RR intervals that are too far from the median of the latest accepted ones
+# and corrects them so that the total time of the series stays the same.
+# Intervals off the rhythm are held until the next ones tell what they were:
+#  - AGREE held intervals in a row that agree with each other are a real change
+#    of rhythm, they're kept as they are and the median starts over from them
+#  - A short interval followed by one that adds up to about a median was an
+#    extra beat, the two are merged into one interval
+#  - A long interval close to n medians is n beats with the ones in between
+#    missed, it's split into n equal parts
+#  - Anything else can't be explained, it's replaced with the median
+class ArtifactFilter:
+    AGREE = 3
+
+    def __init__(self, size=5, tolerance=20) -> None:
+        """
+        Size: The amount of latest accepted intervals the median is taken over
+        Tolerance: Allowed difference to the median in percent, or four times
+                   the median absolute deviation if the intervals vary more
+        Held: Intervals off the rhythm waiting for the next ones, held_count of them
+        Output: The corrected intervals of the latest update(), reused
+        """
+        self.size = size
+        self.tolerance = tolerance
+        self.window = array.array("H", [0] * size)
+        # Scratch space for sorting, the window itself stays in arrival order
+        self.scratch = array.array("H", [0] * size)
+        self.held = array.array("H", [0] * self.AGREE)
+        self.held_count = 0
+        self.index = 0
+        self.count = 0
+        self.output = []
+        self.total = 0
+        self.artifacts = 0
+
+    def reset(self):
+        self.index = 0
+        self.count = 0
+        self.held_count = 0
+        self.total = 0
+        self.artifacts = 0
+
+    # Median of the first count values in scratch, sorts them in place
+    def _median(self, count):
+        scratch = self.scratch
+        # Insertion sort, there are only a handful of values
+        for i in range(1, count):
+            value = scratch[i]
+            j = i - 1
+            while j >= 0 and scratch[j] > value:
+                scratch[j + 1] = scratch[j]
+                j -= 1
+            scratch[j + 1] = value
+        return scratch[count // 2]
+
+    def _accept(self, interval):
+        self.window[self.index] = interval
+        self.index = self.index + 1 if self.index + 1 < self.size else 0
+        if self.count < self.size:
+            self.count += 1
+        self.output.append(interval)
+
+    # Median of the window and the allowed difference to it
+    def _limits(self):
+        for x in range(self.size):
+            self.scratch[x] = self.window[x]
+        median = self._median(self.size)
+        for x in range(self.size):
+            deviation = self.window[x] - median
+            self.scratch[x] = deviation if deviation >= 0 else -deviation
+        deviation_median = self._median(self.size)
+
+        limit = median * self.tolerance // 100
+        if 4 * deviation_median > limit:
+            limit = 4 * deviation_median
+        return median, limit
+
+    # The first count held intervals were artifacts after all, correct them
+    def _correct(self, count, median, limit):
+        output = self.output
+        for x in range(count):
+            interval = self.held[x]
+            self.artifacts += 1
+            beats = (interval + median // 2) // median
+            if beats >= 2 and -limit <= interval - beats * median <= limit:
+                # Missed beats, the parts add up to the interval
+                for y in range(beats):
+                    output.append(
+                        interval * (y + 1) // beats - interval * y // beats
+                    )
+            else:
+                output.append(median)
+        # The rest move to the front
+        for x in range(count, self.held_count):
+            self.held[x - count] = self.held[x]
+        self.held_count -= count
+
+    # True if the held intervals are within the tolerance of each other
+    def _held_agree(self):
+        low = high = self.held[0]
+        for x in range(1, self.held_count):
+            if self.held[x] < low:
+                low = self.held[x]
+            if self.held[x] > high:
+                high = self.held[x]
+        return high - low <= low * self.tolerance // 100
+
+    """
+    Feed one interval, returns a list of the corrected intervals it makes:
+    usually just the interval, nothing while it's held, or the held ones
+    and several parts of a split one once they're resolved. The list is
+    reused by the next call. Up to AGREE - 1 held intervals are still
+    unresolved when the measurement ends.
+    """
+
+    def update(self, interval):
+        output = self.output
+        output.clear()
+        self.total += 1
+        # Not enough history yet to judge
+        if self.count < self.size:
+            self._accept(interval)
+            return output
+
+        median, limit = self._limits()
+        held_count = self.held_count
+        # An extra beat split one interval in two
+        if held_count > 0:
+            last = self.held[held_count - 1]
+            if last < median and -limit <= last + interval - median <= limit:
+                self._correct(held_count - 1, median, limit)
+                self.held_count = 0
+                self.artifacts += 1
+                self._accept(last + interval)
+                return output
+
+        # Back on the rhythm, whatever was held were artifacts
+        if -limit <= interval - median <= limit:
+            self._correct(held_count, median, limit)
+            self._accept(interval)
+            return output
+
+        self.held[held_count] = interval
+        self.held_count = held_count + 1
+        if self.held_count < self.AGREE:
+            return output
+        if self._held_agree():
+            # The rhythm has really changed, start over from the new intervals
+            self.count = 0
+            self.index = 0
+            for x in range(self.held_count):
+                self._accept(self.held[x])
+            self.held_count = 0
+        else:
+            # The oldest one can't wait any longer
+            self._correct(1, median, limit)
+        return output
+
+    # Share of corrected intervals in percent, like Kubios "artefact"
+    def percentage(self):
+        return self.artifacts * 100 / self.total if self.total else 0.0
+
+
+# Baseline and min/max envelopes of the signal, updated on every value.
+# The baseline is an integer exponential moving average, it starts as a
+# plain average so that it's usable right away.
+class EnvelopeTracker:
+    def __init__(self, window=500, decay_shift=8) -> None:
+        """
+        Window: Time constant of the baseline in values (500 is 2 s at 250 Hz)
+        Decay_shift: Min and max envelopes move 1 / 2**decay_shift of the way
+                     back towards the baseline every value
+        Total: Baseline times window, keeps the average without rounding drift
+        """
+        self.window = window
+        self.decay_shift = decay_shift
+        self.count = 0
+        self.total = 0
+        self.baseline = 0
+        self.min_val = 0
+        self.max_val = 0
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.baseline = 0
+        self.min_val = 0
+        self.max_val = 0
+
+    def update(self, value):
+        if self.count < self.window:
+            # Plain average until the window fills up
+            self.count += 1
+            self.total += value
+            self.baseline = self.total // self.count
+            if self.count == 1:
+                self.min_val = value
+                self.max_val = value
+                return
+        else:
+            self.total += value - self.baseline
+            self.baseline = self.total // self.window
+
+        baseline = self.baseline
+        if value > self.max_val:
+            self.max_val = value
+        else:
+            self.max_val -= (self.max_val - baseline) >> self.decay_shift
+        if value < self.min_val:
+            self.min_val = value
+        else:
+            self.min_val += (baseline - self.min_val) >> self.decay_shift
+
+
+# BPM from RR intervals, smoothed with an exponential moving average of the interval
+class BpmEstimator:
+    def __init__(self, time_constant=3, max_bpm=240) -> None:
+        """
+        Time_constant: Roughly the amount of beats the estimate averages over,
+                       1 means no smoothing at all
+        Max_bpm: Intervals faster than this are rejected as funky values
+        """
+        self.time_constant = time_constant
+        self.min_interval = 60 / max_bpm
+        self.interval = 0.0
+
+    def reset(self):
+        self.interval = 0.0
+
+    # Add an interval in seconds, returns int(BPM) or 0 if the interval was rejected
+    def update(self, interval):
+        if interval < self.min_interval:
+            return 0
+        # The first interval is used as is, no lag before the first reading
+        if self.interval == 0.0:
+            self.interval = interval
+        else:
+            self.interval += (interval - self.interval) / self.time_constant
+        return int(60 / self.interval)
+
+
+# Third-order CIC decimator: three integrators run at the input rate, three combs
+# at the output rate. A fixed amount of integer work per value, and the state
+# wraps at 2**30 so that it stays in small ints
+class CicDecimator:
+    MASK = 0x3FFFFFFF
+
+    def __init__(self, factor) -> None:
+        """
+        Factor: Input values per output value
+        Gain: Factor**3, the sum is divided by it to keep the input scale
+        Settle: Outputs left before the combs are filled with real values
+        """
+        self.factor = factor
+        self.gain = factor * factor * factor
+        self.reset()
+
+    def reset(self):
+        self.integrator1 = 0
+        self.integrator2 = 0
+        self.integrator3 = 0
+        self.comb1 = 0
+        self.comb2 = 0
+        self.comb3 = 0
+        self.phase = 0
+        self.settle = 3
+
+    # Add a value, returns the decimated value on every factor-th call, otherwise 0
+    def update(self, value):
+        mask = self.MASK
+        self.integrator1 = (self.integrator1 + value) & mask
+        self.integrator2 = (self.integrator2 + self.integrator1) & mask
+        self.integrator3 = (self.integrator3 + self.integrator2) & mask
+        self.phase += 1
+        if self.phase < self.factor:
+            return 0
+        self.phase = 0
+
+        # The wrapping cancels out in the differences
+        value = self.integrator3
+        stage1 = (value - self.comb1) & mask
+        self.comb1 = value
+        stage2 = (stage1 - self.comb2) & mask
+        self.comb2 = stage1
+        stage3 = (stage2 - self.comb3) & mask
+        self.comb3 = stage2
+        if self.settle > 0:
+            self.settle -= 1
+            return 0
+        return stage3 // self.gain
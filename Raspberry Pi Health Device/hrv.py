@@ -0,0 +1,209 @@
+import array
+import math
+
+
+# Histogram of intervals for the stress index, 50 ms bins from 0 to 2000 ms
+HISTOGRAM_BIN = 50
+HISTOGRAM_BINS = 40
+
+
+# Time-domain HRV that is updated as each interval arrives (Welford's method),
+# the analysis is ready at any moment without another pass over the intervals
+class HrvAccumulator:
+    def __init__(self) -> None:
+        """
+        Mean, m2: Running mean and sum of squared deviations of the intervals
+        Ssd: Sum of squared differences between successive intervals
+        Nn50: Successive differences over 50 ms
+        Bpm_sum: Sum of the beats per minute of every interval
+        Histogram: Interval counts in HISTOGRAM_BIN ms buckets
+        """
+        self.histogram = array.array("H", [0] * HISTOGRAM_BINS)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.first = 0
+        self.previous = 0
+        self.ssd = 0
+        self.nn50 = 0
+        self.bpm_sum = 0.0
+        self.min_rr = 0
+        self.max_rr = 0
+        for x in range(HISTOGRAM_BINS):
+            self.histogram[x] = 0
+
+    # Add an interval in milliseconds
+    def add(self, interval):
+        self.count += 1
+        delta = interval - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (interval - self.mean)
+
+        if self.count > 1:
+            difference = interval - self.previous
+            self.ssd += difference * difference
+            if difference > 50 or difference < -50:
+                self.nn50 += 1
+            if interval < self.min_rr:
+                self.min_rr = interval
+            if interval > self.max_rr:
+                self.max_rr = interval
+        else:
+            self.first = interval
+            self.min_rr = interval
+            self.max_rr = interval
+        self.previous = interval
+
+        self.bpm_sum += 60000 / interval
+
+        bucket = interval // HISTOGRAM_BIN
+        self.histogram[bucket if bucket < HISTOGRAM_BINS else HISTOGRAM_BINS - 1] += 1
+
+    # Square root of Baevsky's stress index, like Kubios reports it
+    def stress_index(self):
+        if self.max_rr == self.min_rr:
+            return 0.0
+        mode = 0
+        for x in range(1, HISTOGRAM_BINS):
+            if self.histogram[x] > self.histogram[mode]:
+                mode = x
+        # Amplitude of the mode (%), mode (s) and variation range (s)
+        amplitude = self.histogram[mode] * 100 / self.count
+        mode_s = (mode * HISTOGRAM_BIN + HISTOGRAM_BIN / 2) / 1000
+        variation = (self.max_rr - self.min_rr) / 1000
+        return math.sqrt(amplitude / (2 * mode_s * variation))
+
+    # Same dictionary as Kubios JSON, only the local keys
+    def result(self):
+        count = self.count
+        sdnn = math.sqrt(self.m2 / count) if count else 0.0
+        rmssd = 0.0
+        sd1 = 0.0
+        sd2 = 0.0
+        if count > 1:
+            rmssd = math.sqrt(self.ssd / (count - 1))
+            # Successive differences add up to last - first
+            mean_difference = (self.previous - self.first) / (count - 1)
+            sdsd_squared = self.ssd / (count - 1) - mean_difference * mean_difference
+            # Poincare plot widths
+            sd1 = math.sqrt(max(0.0, sdsd_squared / 2))
+            sd2 = math.sqrt(max(0.0, 2 * sdnn * sdnn - sdsd_squared / 2))
+        return {
+            "analysis": {
+                # Mean of PP interval values (named rr because Kubios JSON)
+                "mean_rr_ms": self.mean,
+                # Mean of beats per minute
+                "mean_hr_bpm": self.bpm_sum / count if count else 0.0,
+                "min_hr_bpm": 60000 / self.max_rr if count else 0.0,
+                "max_hr_bpm": 60000 / self.min_rr if count else 0.0,
+                # Square root of mean squared differences between successive PP intervals
+                "rmssd_ms": rmssd,
+                # Standard deviation of PP intervals
+                "sdnn_ms": sdnn,
+                # Share of successive differences over 50 ms
+                "pnn50_prc": self.nn50 * 100 / (count - 1) if count > 1 else 0.0,
+                "sd1_ms": sd1,
+                "sd2_ms": sd2,
+                "stress_index": self.stress_index(),
+            }
+        }
+
+
+# Time-domain HRV over the latest intervals only. Integer running sums over a ring,
+# so adding an interval and dropping the oldest one is O(1) and doesn't drift
+class SlidingHrv:
+    def __init__(self, size=30) -> None:
+        """
+        Size: The amount of latest intervals in the window
+        Intervals: Ring of the intervals in milliseconds
+        Squares: Squared difference of each interval to the one before it
+        Centibeats: Beats per minute of each interval times 100
+        """
+        self.size = size
+        self.intervals = array.array("H", [0] * size)
+        self.squares = array.array("L", [0] * size)
+        self.centibeats = array.array("L", [0] * size)
+        self.index = 0
+        self.count = 0
+        self.previous = 0
+        self.total = 0
+        self.total_squared = 0
+        self.ssd = 0
+        self.bpm_total = 0
+
+    def reset(self):
+        for x in range(self.size):
+            self.intervals[x] = 0
+            self.squares[x] = 0
+            self.centibeats[x] = 0
+        self.index = 0
+        self.count = 0
+        self.previous = 0
+        self.total = 0
+        self.total_squared = 0
+        self.ssd = 0
+        self.bpm_total = 0
+
+    # Add an interval in milliseconds, the oldest one drops out once the window is full
+    def add(self, interval):
+        index = self.index
+        size = self.size
+
+        if self.count == size:
+            oldest = self.intervals[index]
+            self.total -= oldest
+            self.total_squared -= oldest * oldest
+            self.bpm_total -= self.centibeats[index]
+            # The next one becomes the oldest, its difference falls out of the window
+            following = index + 1 if index + 1 < size else 0
+            self.ssd -= self.squares[following]
+            self.squares[following] = 0
+        else:
+            self.count += 1
+
+        if self.count > 1:
+            difference = interval - self.previous
+            self.squares[index] = difference * difference
+            self.ssd += difference * difference
+        else:
+            self.squares[index] = 0
+        self.previous = interval
+
+        centibeats = 6000000 // interval
+        self.intervals[index] = interval
+        self.centibeats[index] = centibeats
+        self.total += interval
+        self.total_squared += interval * interval
+        self.bpm_total += centibeats
+
+        self.index = index + 1 if index + 1 < size else 0
+
+    def mean_rr(self):
+        return self.total / self.count if self.count else 0.0
+
+    def mean_hr(self):
+        return self.bpm_total / 100 / self.count if self.count else 0.0
+
+    def rmssd(self):
+        return math.sqrt(self.ssd / (self.count - 1)) if self.count > 1 else 0.0
+
+    def sdnn(self):
+        count = self.count
+        if not count:
+            return 0.0
+        variance = (count * self.total_squared - self.total * self.total) / count / count
+        return math.sqrt(variance)
+
+    # Same dictionary as HrvAccumulator.result()
+    def result(self):
+        return {
+            "analysis": {
+                "mean_rr_ms": self.mean_rr(),
+                "mean_hr_bpm": self.mean_hr(),
+                "rmssd_ms": self.rmssd(),
+                "sdnn_ms": self.sdnn(),
+            }
+        }
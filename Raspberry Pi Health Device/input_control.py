@@ -1,7 +1,8 @@
-from machine import Pin, ADC, I2C
+from machine import Pin, ADC, I2C, idle
 from filefifo import Filefifo
 from fifo import Fifo
 from ssd1306 import SSD1306_I2C
+from renderer import Renderer
 import time
 
 
@@ -9,7 +10,7 @@ import time
 class Button:
     def __init__(self):
         self.sw = Pin(12, Pin.IN, Pin.PULL_UP)
-        self.btn_fifo = Fifo(30, typecode="i")
+        self.btn_fifo = Fifo(30, typecode="i", overflow=Fifo.DROP_NEWEST)
         self.sw.irq(handler=self.btn_handler, trigger=Pin.IRQ_RISING, hard=False)
         self.last_press_time = 0  # Variable to store the last press time
 
@@ -25,7 +26,7 @@ class Rotary:
     def __init__(self):
         self.right = Pin(10, mode=Pin.IN, pull=Pin.PULL_UP)
         self.left = Pin(11, mode=Pin.IN, pull=Pin.PULL_UP)
-        self.rot_fifo = Fifo(100, typecode="i")
+        self.rot_fifo = Fifo(100, typecode="i", overflow=Fifo.DROP_NEWEST)
         self.right.irq(
             handler=self.rot_handler, trigger=Pin.IRQ_RISING, hard=True
         )  # Interrupter
@@ -58,7 +59,9 @@ class Rotary:
 class Sensor:
     def __init__(self):
         self.adc = ADC(Pin(26, Pin.IN))
-        self.adc_fifo = Fifo(500)
+        # Hard ISR fills this, a full fifo drops the new sample instead of raising.
+        # Every item is a sample and its sequence number, see Measure.pio_handler
+        self.adc_fifo = Fifo(500, typecode="L", overflow=Fifo.DROP_NEWEST)
 
 
 # Home for all the inputs
@@ -86,28 +89,59 @@ class Screen(Inputs):
         self.TEXT_HEIGHT = 15
         self.CURRENT_SCREEN = 0
         self.MENU_ROWS = 3
+        # Submenu items are listed from row 2 downwards
+        self.SUBMENU_ITEMS = 1
 
         self.oled = SSD1306_I2C(self.OLED_WIDTH, self.OLED_HEIGHT, self.i2c)
+        # Partial, rate-limited updates for the measurement screens
+        self.FRAME_RATE = 20
+        self.renderer = Renderer(self.oled, self.FRAME_RATE)
         self.selected_row = 0  # Set starting value of row selector for the menu
-
-        # Current menu states
-        self.main_menu = True
-        self.hr_menu = False
-        self.hrv_menu = False
-        self.kubios_menu = False
-        self.history_menu = False
+        # Rendered menus without the selector, keyed by layout and items
+        self.MENU_CACHE_SIZE = 8
+        self.menu_cache = {}
+        # The menu that is on screen, moving the selector restores from it
+        self.menu_background = None
+
+        # Menu states, the current one is in .menu_state
+        self.MAIN_MENU = 0
+        self.HR_MENU = 1
+        self.HRV_MENU = 2
+        self.KUBIOS_MENU = 3
+        self.HISTORY_MENU = 4
+        self.menu_state = self.MAIN_MENU
+
+    # Submenus list their items from row 2 downwards
+    def in_submenu(self):
+        return self.menu_state in (self.HR_MENU, self.HRV_MENU, self.KUBIOS_MENU)
+
+    # Sleep until the knob is pressed, any interrupt wakes the core up to check
+    def wait_button(self):
+        while self.btn_fifo.empty():
+            idle()
+        self.btn_fifo.get()
 
     # this function creates selector bar for menus
     def selector(self, direction, maximum_items):
         screen = self.oled
         self.selected_row += direction
         # Limiting max and min values
-        if self.main_menu:
+        if self.menu_state == self.MAIN_MENU:
             if self.selected_row < 0:
                 self.selected_row = 0
         if self.selected_row >= maximum_items:
             self.selected_row = maximum_items
 
+        # Prevent selector not to go to empty space
+        if self.in_submenu():
+            last_row = 1 + self.SUBMENU_ITEMS
+            if self.selected_row >= last_row:
+                self.selected_row = last_row
+            if self.selected_row < 2 and direction < 0:
+                self.selected_row = -1
+            elif self.selected_row < 2 and direction > 0:
+                self.selected_row = 2
+
         # Draws rectangle around selection
         if self.selected_row <= -1:
             self.selected_row = -1
@@ -120,15 +154,38 @@ class Screen(Inputs):
                 self.TEXT_HEIGHT + 2,
                 1,
             )
+        return self.selected_row
 
-        # Prevent selector not to go to empty space
-        if self.kubios_menu or self.hr_menu or self.hrv_menu:
-            if self.selected_row >= 2:
-                self.selected_row = 2
-            if self.selected_row < 2 and direction == -1:
-                self.selected_row = -1
-            elif self.selected_row - 1 and direction == 1:
-                self.selected_row = 2
+    # Area of the selector rectangle on a row, corners are inclusive
+    def selector_area(self, row):
+        if row <= -1:
+            return 0, 0, 19, self.TEXT_HEIGHT + 1
+        y = row * self.TEXT_HEIGHT
+        return 0, y, self.OLED_WIDTH - 1, y + self.TEXT_HEIGHT + 1
+
+    # Move the selector on the menu that is on screen, only the old and the new
+    # rectangle are redrawn and sent to the display
+    def move_selector(self, direction, maximum_items):
+        background = self.menu_background
+        if background is None:
+            self.selector(direction, maximum_items)
+            self.renderer.show()
+            return self.selected_row
+
+        # Put the menu back under the old rectangle, a page at a time
+        buffer = self.oled.buffer
+        x0, y0, x1, y1 = self.selector_area(self.selected_row)
+        last_page = min(y1 >> 3, self.OLED_HEIGHT // 8 - 1)
+        for page in range(y0 >> 3, last_page + 1):
+            start = page * self.OLED_WIDTH + x0
+            end = start + x1 - x0 + 1
+            buffer[start:end] = background[start:end]
+        self.renderer.mark(x0, y0, x1, y1)
+
+        self.selector(direction, maximum_items)
+        x0, y0, x1, y1 = self.selector_area(self.selected_row)
+        self.renderer.mark(x0, y0, x1, y1)
+        self.renderer.flush(force=True)
         return self.selected_row
 
     # adds text to specific row
@@ -143,22 +200,43 @@ class Screen(Inputs):
 
     # this function is for showing menu content
     def show_content(self, menu):
-        self.oled.fill(0)
-        self.selector(0, self.MENU_ROWS)
-        if self.kubios_menu or self.hr_menu or self.hrv_menu:
-            for _, item in enumerate(menu):
-                # Add text to screen
-                self.add_text(item, 50, 2)
+        submenu = self.in_submenu()
+        if submenu:
+            self.SUBMENU_ITEMS = len(menu)
         else:
-            for i, item in enumerate(menu):
-                # Add text to screen
-                self.add_text(item, 50, i)
             self.MENU_ROWS = len(menu) - 1
-        # adds go back button
-        if not self.main_menu:
-            self.add_text("<-", 2, 0)
 
-        self.oled.show()
+        # Each menu is rendered once, after that it's copied from the cache
+        key = (submenu, self.menu_state == self.MAIN_MENU, tuple(menu))
+        background = self.menu_cache.get(key)
+        if background is None:
+            self.oled.fill(0)
+            if submenu:
+                for i, item in enumerate(menu):
+                    # Add text to screen
+                    self.add_text(item, 50, 2 + i)
+            else:
+                for i, item in enumerate(menu):
+                    # Add text to screen
+                    self.add_text(item, 50, i)
+            # adds go back button
+            if self.menu_state != self.MAIN_MENU:
+                self.add_text("<-", 2, 0)
+            # Old history titles pile up, start over instead of growing
+            if len(self.menu_cache) >= self.MENU_CACHE_SIZE:
+                self.menu_cache.clear()
+            background = bytearray(self.oled.buffer)
+            self.menu_cache[key] = background
+        else:
+            self.oled.buffer[:] = background
+        self.menu_background = background
+
+        # Main menu has a hidden diagnostics row below the last item
+        maximum = self.MENU_ROWS
+        if self.menu_state == self.MAIN_MENU:
+            maximum += 1
+        self.selector(0, maximum)
+        self.renderer.show()
 
     # Functions for receiving date and time from Kubios API return
     def date_from_file(self, file):
@@ -181,12 +259,15 @@ class Screen(Inputs):
     hrv_calcs["analysis"]["mean_hr_bpm"]: MEAN HR
     hrv_calcs["analysis"]["rmssd_ms"]: RMSSD
     hrv_calcs["analysis"]["sdnn_ms"]: SDNN
+    hrv_calcs["analysis"]["freq_domain"]["LF_HF_power"]: LF/HF
+    hrv_calcs["analysis"]["stress_index"]: STRESS
 
     If kubios, the same as above, and also:
     hrv_calcs["analysis"]["pns_index"]: MEAN RR
     """
 
     def display_analysis(self, hrv_calcs: dict, is_kubios: bool):
+        self.menu_background = None
         self.oled.fill(0)
         self.add_text("<-", 2, 0)
         self.MENU_ROWS = 0
@@ -234,19 +315,22 @@ class Screen(Inputs):
             self.oled.text(time_hrv, 20, 4, 1)
             self.oled.text(date_hrv, 64, 4, 1)
             self.oled.text(
-                f"mean rr: {hrv_calcs["analysis"]["mean_rr_ms"]:.01f}", 0, 20, 1
+                f"mean rr: {hrv_calcs["analysis"]["mean_rr_ms"]:.01f}", 0, 16, 1
             )
             self.oled.text(
-                f"mean hr: {hrv_calcs["analysis"]["mean_hr_bpm"]:.01f}", 0, 28, 1
+                f"mean hr: {hrv_calcs["analysis"]["mean_hr_bpm"]:.01f}", 0, 24, 1
             )
-            self.oled.text(f"rmssd: {hrv_calcs["analysis"]["rmssd_ms"]:.01f}", 0, 36, 1)
-            self.oled.text(f"sdnn: {hrv_calcs["analysis"]["sdnn_ms"]:.01f}", 0, 44, 1)
+            self.oled.text(f"rmssd: {hrv_calcs["analysis"]["rmssd_ms"]:.01f}", 0, 32, 1)
+            self.oled.text(f"sdnn: {hrv_calcs["analysis"]["sdnn_ms"]:.01f}", 0, 40, 1)
+            if "freq_domain" in hrv_calcs["analysis"]:
+                lf_hf = hrv_calcs["analysis"]["freq_domain"]["LF_HF_power"]
+                self.oled.text(f"lf/hf: {lf_hf:.02f}", 0, 48, 1)
+            if "stress_index" in hrv_calcs["analysis"]:
+                stress = hrv_calcs["analysis"]["stress_index"]
+                self.oled.text(f"stress: {stress:.01f}", 0, 56, 1)
 
         self.selected_row = -1
         self.selector(-1, 0)
         self.oled.show()
-        while True:
-            # Returns when the knob is pressed
-            if self.btn_fifo.has_data():
-                self.btn_fifo.get()
-                break
+        # Returns when the knob is pressed
+        self.wait_button()
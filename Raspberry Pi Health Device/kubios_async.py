@@ -0,0 +1,275 @@
+from operations import Kubios
+import binascii
+import json
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+
+# "https://host:port/path" into (ssl, host, port, path)
+def split_url(url):
+    scheme, rest = url.split("://", 1)
+    ssl = scheme == "https"
+    slash = rest.find("/")
+    if slash == -1:
+        host, path = rest, "/"
+    else:
+        host, path = rest[:slash], rest[slash:]
+    port = 443 if ssl else 80
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+    return ssl, host, port, path
+
+
+# Minimal HTTP/1.0 POST over asyncio streams, returns (status, body as bytes).
+# The server closes the connection after the response, the body is read to the end.
+# No answer or a garbled one raises OSError like a lost connection
+async def http_post(url, body, headers):
+    ssl, host, port, path = split_url(url)
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+    try:
+        request = "POST {} HTTP/1.0\r\nHost: {}\r\nContent-Length: {}\r\n".format(
+            path, host, len(body)
+        )
+        for name in headers:
+            request += "{}: {}\r\n".format(name, headers[name])
+        writer.write(request.encode() + b"\r\n" + body)
+        await writer.drain()
+
+        # Closed without an answer, or something else than HTTP
+        status = (await reader.readline()).split(None, 2)
+        if len(status) < 2 or not status[0].startswith(b"HTTP/"):
+            raise OSError("No HTTP status line")
+        try:
+            status = int(status[1])
+        except ValueError:
+            raise OSError("Bad HTTP status line")
+        # The headers aren't needed, skip to the empty line
+        while True:
+            line = await reader.readline()
+            if not line or line == b"\r\n":
+                break
+        return status, await reader.read(-1)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+# Kubios refused the dataset itself, sending it again won't help
+class UploadRejected(Exception):
+    pass
+
+
+# WLAN connect and Kubios calls as asyncio tasks. While they wait for the network
+# the progress animation and the knob keep running, a press cancels the upload
+class AsyncKubios(Kubios):
+    def __init__(self):
+        # Initialize Kubios
+        super().__init__()
+
+        # Seconds for the WLAN to come up, and for each Kubios request
+        self.WLAN_TIMEOUT = 7.5
+        self.HTTP_TIMEOUT = 15
+        # What the result screens and History read from an analysis
+        self.ANALYSIS_KEYS = (
+            "create_timestamp",
+            "mean_rr_ms",
+            "mean_hr_bpm",
+            "rmssd_ms",
+            "sdnn_ms",
+            "pns_index",
+            "sns_index",
+            "stress_index",
+            "readiness",
+        )
+
+    # Usually the connection manager has the link up already
+    async def connect_wlan_async(self):
+        self.start_wlan()
+        while not self.wlan.isconnected():
+            self.poll_wlan()
+            await asyncio.sleep(0.1)
+
+    # A cached access token, or a new one from TOKEN_URL. "" if that failed
+    async def get_token_async(self):
+        access_token = self.token_cache.get()
+        if access_token:
+            return access_token
+
+        credentials = "{}:{}".format(self.CLIENT_ID, self.CLIENT_SECRET)
+        credentials = binascii.b2a_base64(credentials.encode()).strip().decode()
+        data = "grant_type=client_credentials&client_id={}".format(self.CLIENT_ID)
+        status, body = await http_post(
+            self.TOKEN_URL,
+            data.encode(),
+            {
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Authorization": "Basic " + credentials,
+            },
+        )
+        if not status == 200:
+            return ""
+        response = json.loads(body)
+        access_token = response["access_token"]
+        self.token_cache.set(access_token, response.get("expires_in", 3600))
+        return access_token
+
+    # Readiness analysis of the intervals, returns (status, body)
+    async def analyze_async(self, access_token, intervals):
+        dataset = {"type": "RRI", "data": intervals, "analysis": {"type": "readiness"}}
+        return await http_post(
+            self.ANALYZE_URL,
+            json.dumps(dataset).encode(),
+            {
+                "Content-Type": "application/json",
+                "Authorization": "Bearer {}".format(access_token),
+                "X-Api-Key": self.APIKEY,
+            },
+        )
+
+    """
+    Analyze the intervals, a rejected token is replaced once. Returns the
+    analysis as a dictionary, None if Kubios answered with an error that may
+    go away (5xx, 408, 429). Raises UploadRejected for the other 4xx answers
+    and for an analysis without ANALYSIS_KEYS, OSError if there's no token
+    """
+
+    async def submit_async(self, intervals):
+        access_token = await self.get_token_async()
+        if not access_token:
+            raise OSError("No Kubios access token")
+        status, body = await self.analyze_async(access_token, intervals)
+        # The cached token was expired or revoked after all, get a new one
+        if status == 401:
+            self.token_cache.clear()
+            access_token = await self.get_token_async()
+            if not access_token:
+                raise OSError("No Kubios access token")
+            status, body = await self.analyze_async(access_token, intervals)
+        if 400 <= status < 500 and status not in (401, 408, 429):
+            raise UploadRejected(status)
+        if not status == 200:
+            return None
+        response = json.loads(body)
+        # Fail here rather than on the screens or in History
+        analysis = response.get("analysis") if isinstance(response, dict) else None
+        if not isinstance(analysis, dict):
+            raise UploadRejected("no analysis")
+        for key in self.ANALYSIS_KEYS:
+            if key not in analysis:
+                raise UploadRejected(key)
+        return response
+
+    """
+    Connect and upload the new intervals, the queued ones are left to
+    .upload_next() so that they don't hold up the new result.
+    Returns the analysis, None if it failed. UploadRejected goes through
+    """
+
+    async def upload_async(self, intervals):
+        try:
+            await asyncio.wait_for(self.connect_wlan_async(), self.WLAN_TIMEOUT)
+            return await asyncio.wait_for(
+                self.submit_async(intervals), self.HTTP_TIMEOUT
+            )
+        except (asyncio.TimeoutError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    """
+    Upload the oldest queued measurement, returns its analysis as a json string
+    or "" if it failed. It leaves the queue once the result is in, or is set
+    aside if Kubios refuses it or keeps answering with errors. Failures of the
+    link or the token service don't count against the dataset
+    """
+
+    async def upload_next_async(self):
+        queue = self.upload_queue
+        try:
+            response = await asyncio.wait_for(
+                self.submit_async(queue.peek()), self.HTTP_TIMEOUT
+            )
+        except UploadRejected:
+            queue.reject()
+            return ""
+        except (asyncio.TimeoutError, OSError, KeyError):
+            return ""
+        except (ValueError, TypeError):
+            response = None
+        if response is None:
+            queue.fail()
+            return ""
+        queue.pop()
+        return json.dumps(response)
+
+    # Text with one to three dots, until the task is cancelled
+    async def progress(self, text):
+        dots = 1
+        while True:
+            self.oled.fill(0)
+            self.add_text(text + "." * dots, 50, 2)
+            self.add_text("Press to cancel", 50, 3)
+            self.oled.show()
+            dots = dots + 1 if dots < 3 else 1
+            await asyncio.sleep(0.25)
+
+    # Run the coroutine with the animation, a knob press cancels it.
+    # Returns what the coroutine returned, None if it was cancelled
+    async def run_cancellable(self, coroutine, text):
+        task = asyncio.create_task(coroutine)
+        animation = asyncio.create_task(self.progress(text))
+        try:
+            while not task.done():
+                if self.btn_fifo.has_data():
+                    self.btn_fifo.get()
+                    task.cancel()
+                    break
+                await asyncio.sleep(0.05)
+            try:
+                return await task
+            except asyncio.CancelledError:
+                return None
+        finally:
+            animation.cancel()
+
+    # Run the coroutine without anything on screen, any knob input cancels it and
+    # is left in the fifos for the menus. Returns None if it was cancelled
+    async def run_background(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        while not task.done():
+            if self.btn_fifo.has_data() or self.rot_fifo.has_data():
+                task.cancel()
+                break
+            await asyncio.sleep(0.02)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            return None
+
+    # One queued measurement for the idle menus, "" if there was nothing to send,
+    # the link is down, or the upload failed or was cancelled
+    def upload_next(self):
+        if not self.upload_queue.pending() or not self.wlan.isconnected():
+            return ""
+        return asyncio.run(self.run_background(self.upload_next_async())) or ""
+
+    """
+    The Kubios flow for the menus, blocks until it's done. Returns the analysis
+    as a json string after showing it, or "" if it failed or was cancelled.
+    Then the intervals are queued and go out with the next upload. None if
+    Kubios refused them, they aren't queued then
+    """
+
+    def calculate_kubios_async(self, intervals):
+        try:
+            response = asyncio.run(
+                self.run_cancellable(self.upload_async(intervals), "Uploading")
+            )
+        except UploadRejected:
+            return None
+        if response is None:
+            self.upload_queue.add(intervals)
+            return ""
+        return self.show_kubios_result(response)
@@ -0,0 +1,59 @@
+import json
+import time
+
+
+# Kubios access token and its deadline, kept in memory and optionally in a file
+# so that it survives a reboot. The deadline is in time.time(), a file is only
+# worth it if the clock is set (e.g. NTP) before the token is used again. The
+# server can still refuse a token that looks valid (401), the caller clears
+# the cache then
+class TokenCache:
+    def __init__(self, name=None, margin=60) -> None:
+        """
+        Name: File to keep the token in, None keeps it in memory only
+        Margin: Seconds before the deadline when the token counts as expired
+        Expires: time.time() of the deadline, 0 when there's no token
+        """
+        self.name = name
+        self.margin = margin
+        self.token = ""
+        self.expires = 0
+        if name:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.name) as file:
+                data = json.load(file)
+            self.token = data["access_token"]
+            self.expires = data["expires"]
+        except (OSError, ValueError, KeyError):
+            self.token = ""
+            self.expires = 0
+
+    def save(self):
+        try:
+            with open(self.name, "w") as file:
+                json.dump({"access_token": self.token, "expires": self.expires}, file)
+        except OSError:
+            # Flash is full or read-only, the token is still cached in memory
+            pass
+
+    # The token, or "" if there's none or it's about to expire
+    def get(self):
+        if self.token and time.time() < self.expires - self.margin:
+            return self.token
+        return ""
+
+    # Store a new token, expires_in comes with it from the server (seconds)
+    def set(self, token, expires_in):
+        self.token = token
+        self.expires = time.time() + expires_in
+        if self.name:
+            self.save()
+
+    def clear(self):
+        self.token = ""
+        self.expires = 0
+        if self.name:
+            self.save()
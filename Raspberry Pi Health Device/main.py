@@ -1,7 +1,10 @@
 from history import History
-from operations import Kubios, Internet
+from operations import Internet
+from kubios_async import AsyncKubios
+from machine import idle
 import time
 import json
+import array
 
 
 """
@@ -12,7 +15,7 @@ Remember this with FIFOs!
 """
 
 
-class Main(Kubios, Internet, History):
+class Main(AsyncKubios, Internet, History):
     def __init__(self) -> None:
         # History handles writing and reading previous measures to/from data.
         History.__init__(self)
@@ -26,11 +29,11 @@ class Main(Kubios, Internet, History):
          - Screen:
             - .oled has everything important related to display
          - Measure:
-            - .pulse and .rr_intervals
-              - They both use .slope_detection for algorithm
-              - DON'T USE .slope_detection ALONE!
+            - .heart_rate_detection and .rr_interval_detection
+              - They both use .operate and .detector for algorithm
+              - DON'T USE .detector ALONE!
         """
-        Kubios.__init__(self)
+        AsyncKubios.__init__(self)
 
         """
         WLAN properties are stored in self.wlan for stability reasons.
@@ -40,12 +43,19 @@ class Main(Kubios, Internet, History):
         Internet.__init__(self)
 
         self.update = True
+        # Queued uploads are retried this often while the menus are idle
+        self.UPLOAD_INTERVAL_MS = 30_000
+        self.next_upload = time.ticks_ms()
+
+        # Knob turns are drained from the fifo into this buffer
+        self.rot_block = array.array("i", [0] * 16)
+        self.rot_block_view = memoryview(self.rot_block)
 
         self.main_menu_text = ["HR measure", "Basic HRV", "Kubios HRV", "History"]
 
         self.hr_menu_text = ["Calculate HR"]
 
-        self.hrv_menu_text = ["Calculate HRV"]
+        self.hrv_menu_text = ["Calculate HRV", "Live HRV"]
 
         self.kubios_menu_text = ["Kubios HRV"]
 
@@ -53,6 +63,20 @@ class Main(Kubios, Internet, History):
         self.history_menu_text = ["- EMPTY -", "- EMPTY -", "- EMPTY -", "- EMPTY -"]
         self.update_history_text()
 
+        # The link is ready by the time a measurement is done
+        if self.WLAN_AT_BOOT:
+            self.start_wlan()
+
+        # Menu state machine, every state has its items and a handler for a
+        # knob press. A handler returns the next state and its selected row
+        self.MENUS = {
+            self.MAIN_MENU: (self.main_menu_text, self.main_menu_press),
+            self.HR_MENU: (self.hr_menu_text, self.hr_menu_press),
+            self.HRV_MENU: (self.hrv_menu_text, self.hrv_menu_press),
+            self.KUBIOS_MENU: (self.kubios_menu_text, self.kubios_menu_press),
+            self.HISTORY_MENU: (self.history_menu_text, self.history_menu_press),
+        }
+
     # Update History menu titles to updated analyses from file
     def update_history_text(self):
         self.history_data = self.make_dictionary()
@@ -63,196 +87,204 @@ class Main(Kubios, Internet, History):
                     self.history_data[x + 1]
                 )
 
+    # Main menu functions
+    def main_menu_press(self, row):
+        if row == 0:
+            return self.HR_MENU, 2
+        elif row == 1:
+            return self.HRV_MENU, 2
+        elif row == 2:
+            return self.KUBIOS_MENU, 2
+        elif row == 3:
+            return self.HISTORY_MENU, 0
+        # Hidden diagnostics row, stay in the main menu
+        elif row == 4:
+            self.show_diagnostics()
+            return self.MAIN_MENU, 3
+        return self.MAIN_MENU, row
 
-main = Main()
+    # Heart rate menu functions
+    def hr_menu_press(self, row):
+        # Only if the cursor is pressed on menu option, activate HR
+        # measurement, anything else => main menu
+        if row == 2:
+            print("HR measure")
+            # The process ends when knob is pressed
+            self.heart_rate_detection()
+            print("HR measurement done")
+        return self.MAIN_MENU, 0
+
+    # Basic HRV menu functions
+    def hrv_menu_press(self, row):
+        if row == -1:
+            return self.MAIN_MENU, 1
+        elif row == 2:
+            print("HRV analysis")
+            rr_measures = self.rr_interval_detection()
+            # Knob was pressed during measurement
+            if len(rr_measures) < 29:
+                self.analysis_interrupted()
+            else:
+                local_hrv_analysis = self.local_hrv()
+                # Display the local HRV analysis
+                self.display_analysis(local_hrv_analysis, False)
+        elif row == 3:
+            print("Live HRV")
+            # The process ends when knob is pressed
+            self.live_hrv_detection()
+            print("Live HRV done")
+        return self.MAIN_MENU, 0
+
+    # Kubios menu functions
+    def kubios_menu_press(self, row):
+        if row == -1:
+            return self.MAIN_MENU, 2
+        elif row != 2:
+            return self.MAIN_MENU, 0
+
+        # For debugging
+        """Example_data: [
+            828,
+            836,
+            852,
+            760,
+            800,
+            796,
+            856,
+            824,
+            808,
+            776,
+            724,
+            816,
+            800,
+            812,
+            812,
+            812,
+            756,
+            820,
+            812,
+            800,
+        ]"""
+
+        rr_measures = self.rr_interval_detection()
+        # rr_interval_detection() was interrupted
+        if len(rr_measures) < 29:
+            self.analysis_interrupted()
+            return self.MAIN_MENU, 0
+
+        # Connect to WLAN and make the API calls to Kubios, the knob cancels
+        kubios_measurement = self.calculate_kubios_async(rr_measures)
+        # Queued measurements go out from the idle menus right after
+        self.next_upload = time.ticks_ms()
+        if kubios_measurement:
+            self.store_result(kubios_measurement)
+            self.display_analysis(json.loads(kubios_measurement), True)
+            return self.MAIN_MENU, 0
+
+        self.oled.fill(0)
+        # Kubios refused the data, it isn't queued
+        if kubios_measurement is None:
+            self.add_text("Kubios refused", 50, 1)
+            self.add_text("the data", 50, 2)
+        # Empty if the API call failed, the intervals were queued for later
+        elif self.upload_queue.saved:
+            self.add_text("Saved for", 50, 1)
+            self.add_text("upload", 50, 2)
+        # Queued in memory only, a power off loses it
+        else:
+            self.add_text("Flash full!", 50, 1)
+            self.add_text("Queued for now", 50, 2)
+        self.oled.show()
+        time.sleep(3)
+        return self.MAIN_MENU, 0
+
+    # History menu functions
+    def history_menu_press(self, row):
+        # Go back
+        if row == -1:
+            return self.MAIN_MENU, 3
+        # Any of the four elements, if not empty
+        if 0 <= row <= 3 and self.history_menu_text[row] != "- EMPTY -":
+            self.display_analysis(self.history_data[row + 1], True)
+        return self.HISTORY_MENU, self.selected_row
 
+    # Upload one queued measurement, the result goes to History.
+    # Returns True if History changed
+    def upload_pending(self):
+        kubios_measurement = self.upload_next()
+        if kubios_measurement == "":
+            return False
+        self.store_result(kubios_measurement)
+        return True
 
-#######################################START#################################################
-while True:
-    # menu select
-    if main.update:
-        if main.main_menu:
-            main.show_content(main.main_menu_text)
-            main.update = False
-        elif main.hr_menu:
-            main.show_content(main.hr_menu_text)
-            main.update = False
-
-        elif main.hrv_menu:
-            main.show_content(main.hrv_menu_text)
-            main.update = False
-
-        elif main.kubios_menu:
-            main.show_content(main.kubios_menu_text)
-            main.update = False
-
-        elif main.history_menu:
-            main.show_content(main.history_menu_text)
-            main.update = False
-
-    # Check if knob is rotated
-    while main.rot_fifo.has_data():
-        direction = main.rot_fifo.get()
-        main.selector(direction, main.MENU_ROWS)
-        main.update = True
-
-    # Check if button is pressed
-    while main.btn_fifo.has_data():
-        button_buffer = main.btn_fifo.get()
-        if button_buffer == 1:
-            # Main menu functions
-            if main.main_menu:
-                if main.selected_row == 0:
-                    main.selected_row = 2
-                    main.hr_menu = True
-                elif main.selected_row == 1:
-                    main.selected_row = 2
-                    main.hrv_menu = True
-                elif main.selected_row == 2:
-                    main.selected_row = 2
-                    main.kubios_menu = True
-                elif main.selected_row == 3:
-                    main.selected_row = 0
-                    main.history_menu = True
-                main.main_menu = False
-                main.update = True
-
-            # Heart rate menu functions
-            elif main.hr_menu:
-                # Only if the cursor is pressed on menu option, activate HR
-                # measurement, anything else => main menu
-                if main.selected_row == 2:
-                    print("HR measure")
-                    # The process ends when knob is pressed
-                    main.heart_rate_detection()
-                    print("HR measurement done")
-                main.main_menu = True
-                main.hr_menu = False
-                main.selected_row = 0
-                main.update = True
-
-            # Basic HRV menu functions
-            elif main.hrv_menu:
-                if main.selected_row == -1:
-                    main.main_menu = True
-                    main.selected_row = 1
-                elif main.selected_row == 2:
-                    print("HRV analysis")
-                    rr_measures = main.rr_interval_detection()
-                    # Knob was pressed during measurement
-                    if len(rr_measures) < 29:
-                        main.oled.fill(0)
-                        main.add_text("Analysis interrupted.", 50, 1)
-                        time.sleep(3)
-                        main.kubios_menu = True
-                    else:
-                        local_hrv_analysis = main.local_hrv(rr_measures)
-                        # Display the local HRV analysis
-                        main.display_analysis(local_hrv_analysis, False)
-                    main.selected_row = 0
-                main.main_menu = True
-                main.hrv_menu = False
-                main.update = True
-
-            # Kubios menu functions
-            elif main.kubios_menu:
-                if main.selected_row == -1:
-                    main.main_menu = True
-                    main.selected_row = 2
-                elif main.selected_row == 2:
-                    # Connect to WLAN for Kubios connection
-                    main.connect_wlan()
-                    # If internet connection failed
-                    if not main.wlan.isconnected():
-                        time.sleep(3)
-                        main.selected_row = 3
-                        main.kubios_menu = False
-                        main.main_menu = True
-                        main.update = True
-                    else:
-                        # For debugging
-                        """Example_data: [
-                            828,
-                            836,
-                            852,
-                            760,
-                            800,
-                            796,
-                            856,
-                            824,
-                            808,
-                            776,
-                            724,
-                            816,
-                            800,
-                            812,
-                            812,
-                            812,
-                            756,
-                            820,
-                            812,
-                            800,
-                        ]"""
-
-                        rr_measures = main.rr_interval_detection()
-                        # rr_interval_detection() was interrupted
-                        if len(rr_measures) < 29:
-                            main.oled.fill(0)
-                            main.add_text("Analysis interrupted.", 50, 2)
-                            time.sleep(3)
-                            main.kubios_menu = True
-                        else:
-                            # Make an API call to Kubios
-                            main.oled.fill(0)
-                            main.add_text("Connecting.", 50, 2)
-                            main.oled.show()
-                            kubios_measurement = main.calculate_kubios(rr_measures)
-                            # API call failed
-                            if kubios_measurement == "":
-                                main.kubios_menu = False
-                                main.main_menu = True
-                            else:
-                                # Stores Kubios data to history text file
-                                main.store_data(kubios_measurement)
-                                main.update_history_text()
-                                main.kubios_menu = False
-                                main.display_analysis(
-                                    json.loads(kubios_measurement), True
-                                )
-
-                main.kubios_menu = False
-                main.main_menu = True
-                main.selected_row = 0
-                main.update = True
-
-            # History menu functions
-            elif main.history_menu:
-                # First element, if not empty
-                if main.selected_row == 0 and main.history_menu_text[0] != "- EMPTY -":
-                    main.display_analysis(main.history_data[1], True)
-                    # print("1. History")  # history 1 file
-                # Second element
-                elif (
-                    main.selected_row == 1 and main.history_menu_text[1] != "- EMPTY -"
-                ):
-                    main.display_analysis(main.history_data[2], True)
-                    # print("2. History")  # history 2 file
-                # Third element
-                elif (
-                    main.selected_row == 2 and main.history_menu_text[2] != "- EMPTY -"
-                ):
-                    main.display_analysis(main.history_data[3], True)
-                    # print("3. History")  # history 3 file
-                # Fourth element
-                elif (
-                    main.selected_row == 3 and main.history_menu_text[3] != "- EMPTY -"
-                ):
-                    main.display_analysis(main.history_data[4], True)
-                    # print("4. History")  # history 4 file
-
-                # Go back
-                elif main.selected_row == -1:
-                    main.main_menu = True
-                    main.selected_row = 3
-                    main.history_menu = False
-                main.update = True
+    # Stores Kubios data to history text file
+    def store_result(self, kubios_measurement):
+        self.store_data(kubios_measurement)
+        self.update_history_text()
+
+    def analysis_interrupted(self):
+        self.oled.fill(0)
+        self.add_text("Analysis interrupted.", 50, 2)
+        self.oled.show()
+        time.sleep(3)
+
+    # Knob turns in the fifo added up, a fast spin is one move
+    def knob_steps(self):
+        steps = 0
+        count = self.rot_fifo.get_into(self.rot_block_view)
+        while count > 0:
+            for x in range(count):
+                steps += self.rot_block[x]
+            count = self.rot_fifo.get_into(self.rot_block_view)
+        return steps
+
+    # Event loop: draws the menu of the current state, dispatches knob input to
+    # it and sleeps until the next interrupt when there's nothing to do
+    def run(self):
+        while True:
+            # menu select
+            if self.update:
+                self.show_content(self.MENUS[self.menu_state][0])
+                self.update = False
+
+            # Check if knob is rotated
+            steps = self.knob_steps()
+            if steps != 0:
+                # Main menu has a hidden diagnostics row below the last item
+                maximum = self.MENU_ROWS
+                if self.menu_state == self.MAIN_MENU:
+                    maximum += 1
+                self.move_selector(steps, maximum)
+                # Kubios HRV highlighted, get the link up in the meantime
+                if self.menu_state == self.MAIN_MENU and self.selected_row == 2:
+                    self.start_wlan()
+
+            # Check if button is pressed
+            while self.btn_fifo.has_data():
+                if self.btn_fifo.get() == 1:
+                    press = self.MENUS[self.menu_state][1]
+                    self.menu_state, self.selected_row = press(self.selected_row)
+                    self.update = True
+
+            if self.update:
+                continue
+            # Keep the WLAN up, reconnect if it drops
+            self.poll_wlan()
+            # Queued measurements go out in the background when the link is up,
+            # one per round so that the knob gets a look in between
+            if self.upload_queue.pending():
+                now = time.ticks_ms()
+                if time.ticks_diff(now, self.next_upload) >= 0:
+                    self.next_upload = time.ticks_add(now, self.UPLOAD_INTERVAL_MS)
+                    if self.upload_pending():
+                        # The rest go right after this one
+                        self.next_upload = now
+                        # The history menu shows the new dates right away
+                        if self.menu_state == self.HISTORY_MENU:
+                            self.update = True
+                        continue
+            idle()
+
+
+main = Main()
+main.run()
@@ -2,11 +2,25 @@ from input_control import Screen
 from piotimer import Piotimer
 from filefifo import Filefifo
 from fifo import Fifo
+from filters import (
+    MovingAverage,
+    ArtifactFilter,
+    EnvelopeTracker,
+    BpmEstimator,
+    CicDecimator,
+)
+from capture import CaptureWriter
+from diagnostics import Stats, ADC_GET, DETECT, ECG_DRAW, OLED_SHOW, STAGE_NAMES
+from detector import BeatDetector
+from hrv import HrvAccumulator, SlidingHrv
+from spectrum import FrequencyHrv
+from kubios_token import TokenCache
+from upload_queue import UploadQueue
+from machine import idle
 import network
-import urequests as requests
 import time
 import json
-import math
+import array
 
 # from time import sleep_ms
 import framebuf
@@ -16,24 +30,39 @@ import heart_27_26
 import smiley
 import crying26_26
 
+# The second core of the RP2040 runs the one extra thread that _thread allows,
+# hosts without _thread run it as an ordinary thread
+try:
+    from _thread import start_new_thread
+except ImportError:
+    from threading import Thread
+
+    def start_new_thread(function, args):
+        Thread(target=function, args=args, daemon=True).start()
+
 """
 NOTE: QUICK CHEATSHEET FOR FUNCTION FLOW:
 Heart rate detection:
  - .heart_rate_detection() gets value from:
-  - .operate(), which gets calculated ADC values until sufficient ones activate:
-   - .slope_detection(), which returns an PP interval if the measurement was a success.
- - .heart_rate_detection() adds this value to PP interval list, then gets an averaged BPM from:
-  - .pulse(), which receives a list of PP intervals and the amount of averaging, returns int(BPM)
- - .heart_rate_detection() adds this to a sum, which is then divided by the amount of BPM in the sum
- - This evaluates a BPM to display on the screen. No returns to make sure it keeps looping.
+  - .operate(), which feeds every calculated ADC value once to:
+   - .detector (BeatDetector), which keeps the slope state and emits beats with a sample index.
+  - .operate() returns the PP interval between two beats.
+ - .heart_rate_detection() gives this value to:
+  - .bpm_estimator (BpmEstimator), which smooths the intervals and returns int(BPM)
+ - The BPM is displayed on the screen on every beat. No returns to make sure it keeps looping.
  - The function ends, once the rotary knob has been pressed.
 
 PP interval detection (The variables are named RR, this was before Aleksi found out they are different things.)
  - .rr_interval_detection() builds an empty list, then loops:
-  - .operate(), which loops ADC values until an expression is filled, triggering:
-   - .slope_detection(), which returns an RR interval, if successful.
+  - .operate(), which loops ADC values through .detector until it emits a beat,
+    and returns an RR interval, if successful.
  - .rr_interval_detection() then multiplies that by 1000, and adds it to the list
  - Once the list has 30 items, it removes the first one in it, and returns it.
+
+Dual core mode (.dual_core):
+ - .start_sampling() starts .acquisition_loop() on the second core, it runs .detect()
+   and puts every interval (in samples) to .beat_fifo.
+ - .operate() then waits on .beat_fifo, drawing the ECG and watching the knob meanwhile.
 """
 
 
@@ -46,231 +75,370 @@ class Measure(Screen):
         # This determines whether the program uses test data or real data
         self.test_mode = False
 
+        # Rate of the values going to the detector. With DECIMATION over 1 the ADC
+        # is oversampled that many times faster and the CIC decimator brings it
+        # down to SAMPLE_RATE, at the cost of as many more ISR and adc_get rounds
+        self.SAMPLE_RATE = 250
+        self.DECIMATION = 1
+        self.ADC_RATE = self.SAMPLE_RATE * self.DECIMATION
+        # Rate of the values in adc_get, ADC_RATE or the rate of the test capture
+        self.source_rate = self.ADC_RATE
+        self.decimator = CicDecimator(self.DECIMATION)
+        # Latest in-range value, the decimator gets it in place of a rejected one
+        self.adc_held = 0
+        # The fifo holds two seconds of samples at any ADC rate
+        if self.adc_fifo.size < 2 * self.ADC_RATE:
+            self.adc_fifo = Fifo(
+                2 * self.ADC_RATE, typecode="L", overflow=Fifo.DROP_NEWEST
+            )
+
         # If the values are coming from pulse sensor
         if self.test_mode:
-            # Create a filefifo from sample values
-            self.measure_test_files = Filefifo(size=100, name="capture01_250Hz.txt")
+            # Create a filefifo from sample values, the file is parsed only once.
+            # rate=250 replays the capture in real time, 0 as fast as possible
+            self.measure_test_files = Filefifo(
+                size=100, name="capture01_250Hz.txt", rate=0
+            )
+
+        # Records the raw sensor values of every measurement to RECORD_FILE,
+        # Filefifo can replay the recording in test mode
+        self.record_mode = False
+        self.RECORD_FILE = "capture.bin"
+        self.recorder = None
 
         #######################################################
-        # Max size of five integers, values gotten from file or sensor
-        self.normalizing_values = []
-        # Sample amount per calculation
-        self.samples = 0
+        # Raw values are drained from the fifo a block at a time
+        self.ADC_BLOCK_SIZE = 32
+        self.adc_block = array.array("L", [0] * self.ADC_BLOCK_SIZE)
+        self.adc_block_view = memoryview(self.adc_block)
+        # Test files hold bare values without sequence numbers
+        self.test_block = array.array("H", [0] * self.ADC_BLOCK_SIZE)
+        self.test_block_view = memoryview(self.test_block)
+        self.adc_block_len = 0
+        self.adc_block_pos = 0
+        # Every sample carries a 14-bit sequence number from the ISR. The gaps
+        # between them keep the sample index true to time even when the fifo
+        # drops samples or adc_get rejects them
+        self.SEQ_MASK = 0x3FFF
+        self.adc_seq = 0
+        self.adc_seq_seen = 0
+        self.sample_index = 0
+        # ISR timing, largest deviation from the sample period in microseconds
+        self.SAMPLE_PERIOD_US = 1_000_000 // self.ADC_RATE
+        self.isr_tick = 0
+        self.isr_ticking = False
+        self.isr_jitter = 0
+        # Moving average over the latest 80 ms of values, gotten from file or sensor
+        self.NORMALIZING_WINDOW = self.SAMPLE_RATE * 2 // 25
+        self.normalizing_filter = MovingAverage(self.NORMALIZING_WINDOW)
+        # Streaming slope state machine, keeps its state between samples
+        self.detector = BeatDetector()
+        # Per-stage profiling of the measurement loop. The stage timings cost two
+        # ticks_us() calls per stage and sample, so they're only taken with PROFILE
+        self.PROFILE = False
+        self.stats = Stats()
+        # Missed beats are split and extra beats merged before they reach the RR list
+        self.artifact_filter = ArtifactFilter()
+        # Latest RR intervals, and their HRV that is updated with every interval
+        self.rr_intervals = []
+        self.hrv = HrvAccumulator()
+        # Live HRV keeps measuring, the analysis covers the latest intervals
+        self.LIVE_HRV_WINDOW = 30
+        self.live_hrv = SlidingHrv(self.LIVE_HRV_WINDOW)
+        # LF/HF analysis without Kubios, tables are computed here once
+        self.frequency_hrv = FrequencyHrv()
         ## Averaging the BPM
-        self.prev_beat = 0
+        self.bpm_estimator = BpmEstimator(time_constant=3)
         # Current BPM
         self.current_bpm = 0
-        # The average of received values
-        self.measure_average = 0
-        self.min_val = 0
-        self.max_val = 0
+        # Baseline (the detection threshold) and min/max for ECG, always up to date
+        self.envelope = EnvelopeTracker(2 * self.SAMPLE_RATE)
         #######################################################
         # ECG variables
-        self.ecg_fifo = Fifo(500)
+        # Filled and emptied by the main loop, only the newest points matter
+        self.ecg_fifo = Fifo(500, overflow=Fifo.OVERWRITE_OLDEST)
+        self.ecg_block = array.array("H", [0] * 16)
+        self.ecg_block_view = memoryview(self.ecg_block)
+        # Points per second on the plot, every ECG_DECIMATION outputs make one
+        self.ECG_RATE = 25
+        self.ECG_DECIMATION = self.SAMPLE_RATE // self.ECG_RATE
         self.ecg_average = 0
         self.ecg_count = 0
         self.ecg_x_index = 0
         self.ecg_y_index = 0
+        #######################################################
+        # Dual core mode: acquisition and beat detection run on the second core,
+        # this one keeps the display and the knob. Beats come over in beat_fifo
+        # as intervals in samples
+        self.dual_core = False
+        self.beat_fifo = Fifo(30, overflow=Fifo.DROP_NEWEST)
+        self.acquiring = False
+        self.core1_running = False
 
     # Interrupt handler for timer, whether this is active is decided below
     def pio_handler(self, var):
-        self.adc_fifo.put(self.adc.read_u16())
+        now = time.ticks_us()
+        # The sample and its sequence number in one word, the word stays a
+        # small int so that the hard ISR doesn't allocate
+        self.adc_seq = (self.adc_seq + 1) & self.SEQ_MASK
+        self.adc_fifo.put(self.adc_seq << 16 | self.adc.read_u16())
+
+        # The first call after start has no previous tick to compare to
+        if self.isr_ticking:
+            jitter = time.ticks_diff(now, self.isr_tick) - self.SAMPLE_PERIOD_US
+            if jitter < 0:
+                jitter = -jitter
+            if jitter > self.isr_jitter:
+                self.isr_jitter = jitter
+        self.isr_ticking = True
+        self.isr_tick = now
 
     # Get values from self.adc_fifo
     def adc_get(self):
         output = 0
         value = 0
 
-        avg_amount = 20
-
         # Ends when a valid value is entered to output
         while output == 0:
-            # In case the user presses knob, exiting
-            while self.btn_fifo.has_data():
+            # In case the user presses knob, exiting. In dual core mode the
+            # first core owns the knob and stops this one through .acquiring
+            if self.dual_core:
+                if not self.acquiring:
+                    return -1
+            elif self.btn_fifo.has_data():
                 self.btn_fifo.get()
                 return -1
 
-            # Test files for debugging reasons
-            if self.test_mode:
-                while self.measure_test_files.has_data():
-                    value = self.measure_test_files.get()
+            # Out of values, drain the next block from the fifo
+            if self.adc_block_pos >= self.adc_block_len:
+                # Test files for debugging reasons, otherwise live data
+                if self.test_mode:
+                    self.adc_block_len = self.measure_test_files.get_into(
+                        self.test_block_view
+                    )
+                    # A test capture without repeat has been replayed to the end
+                    if self.adc_block_len == 0:
+                        if self.measure_test_files.eof():
+                            return -1
+                else:
+                    self.adc_block_len = self.adc_fifo.get_into(self.adc_block_view)
+                self.adc_block_pos = 0
+
+            block = self.test_block if self.test_mode else self.adc_block
+            while self.adc_block_pos < self.adc_block_len:
+                word = block[self.adc_block_pos]
+                self.adc_block_pos += 1
+                if self.test_mode:
+                    # One value per sample period
+                    value = word
+                    self.sample_index += 1
+                else:
+                    # Low half is the sample, high half its sequence number
+                    value = word & 0xFFFF
+                    seq = word >> 16
+                    self.sample_index += (seq - self.adc_seq_seen) & self.SEQ_MASK
+                    self.adc_seq_seen = seq
+                    # Raw values, before any filtering
+                    if self.recorder:
+                        self.recorder.put(value)
+                if self.decimator.factor > 1:
+                    # Every sample goes to the decimator to keep its phase with
+                    # the sample clock, a rejected one as the latest good value
                     if 10_000 < value < 60_000:
-                        self.samples += 1
-                        output = value
-                        break
-            # Using live data
-            else:
-                while self.adc_fifo.has_data():
-                    value = self.adc_fifo.get()
-                    if 10_000 < value < 60_000:
-                        self.samples += 1
-                        output = value
-                        break
-
-        previous = len(self.normalizing_values)
-        """
-        If the list of 10 previous normalized values goes over,
-        pop the last one
-        Otherwise just add the new value to the list
-        """
-        if previous >= avg_amount:
-            self.normalizing_values.pop(0)
-        self.normalizing_values.append(output)
-
-        # The output becomes (all values / list length + new value)
-        output = int(sum(self.normalizing_values) / (previous + 1))
-
-        # ECG stuff, every 10 outputs is put to ECG fifo for displaying
+                        self.adc_held = value
+                    elif self.adc_held == 0:
+                        continue
+                    else:
+                        value = self.adc_held
+                    value = self.decimator.update(value)
+                    # Not the decimator's turn to output
+                    if value == 0:
+                        continue
+                    output = value
+                    break
+                elif 10_000 < value < 60_000:
+                    output = value
+                    break
+
+        # The output becomes the average of the latest NORMALIZING_WINDOW values
+        output = self.normalizing_filter.add(output)
+
+        # ECG stuff, every ECG_DECIMATION outputs is put to ECG fifo for displaying
         self.ecg_average += output
         self.ecg_count += 1
-        if self.ecg_count >= 10:
+        if self.ecg_count >= self.ECG_DECIMATION:
             self.ecg_fifo.put(int(self.ecg_average / self.ecg_count))
             self.ecg_average = 0
             self.ecg_count = 0
 
         return output
 
-    # Get the average of approx. two seconds' worth of valid values
-    def measure_avg(self):
-        limit = 500
-        value = 0
-        total = 0
-
-        # Upper and lower limits for ECG
-        self.min_val = self.adc_get()
-        self.max_val = self.adc_get()
-
-        for _ in range(limit):
-            value = self.adc_get()
-
-            # User has pressed the knob
-            if self.min_val == -1 or self.max_val == -1 or value == -1:
-                return -1
-
-            self.min_val = value if value < self.min_val else self.min_val
-            self.max_val = value if value > self.max_val else self.max_val
-
-            total += value
-
-        output = int(total / limit)
-        self.samples = 0
-        return output
-
-    def slope_detection(self):
-        # Counting every sample for RR interval
-        # Rising tracks the direction of the slope
-        rising = 0
-        self.samples = 0
-
-        while True:
-            # Check if ECG can draw
-            self.ecg_draw()
-
-            # Get two points for direction of the slope
-            value = self.adc_get()
-            next_value = self.adc_get()
-
-            if value == -1 or next_value == -1:
-                return -1.0
+    # Turn on the Piotimer, and the recorder if record mode is on
+    def start_sampling(self):
+        self.detector.reset()
+        self.envelope.reset()
+        self.stats.reset()
+        self.adc_fifo.reset_stats()
+        # The timer isn't running yet, the ISR counters can be set here
+        self.adc_seq = 0
+        self.adc_seq_seen = 0
+        self.sample_index = 0
+        self.isr_jitter = 0
+        self.isr_ticking = False
+
+        # Binary test captures know their rate, text files are at SAMPLE_RATE
+        if self.test_mode:
+            self.source_rate = self.measure_test_files.sample_rate or self.SAMPLE_RATE
+            # A paced replay starts now, not when the Filefifo was made
+            self.measure_test_files.restart()
+        else:
+            self.source_rate = self.ADC_RATE
+        factor = max(1, self.source_rate // self.SAMPLE_RATE)
+        if factor != self.decimator.factor:
+            self.decimator = CicDecimator(factor)
+        self.decimator.reset()
+        self.adc_held = 0
+
+        if self.record_mode and not self.test_mode:
+            self.recorder = CaptureWriter(self.RECORD_FILE, self.ADC_RATE)
+        self.measure_timer = Piotimer(freq=self.ADC_RATE, callback=self.pio_handler)
+
+        if self.dual_core:
+            self.beat_fifo.clear()
+            # Both cores use the ECG fifo, only dropping keeps it safe
+            self.ecg_fifo.overflow = Fifo.DROP_NEWEST
+            self.acquiring = True
+            self.core1_running = True
+            start_new_thread(self.acquisition_loop, ())
+        else:
+            self.ecg_fifo.overflow = Fifo.OVERWRITE_OLDEST
+
+    # Turn off the Piotimer and the recorder, then empty the fifos
+    def stop_sampling(self):
+        # The second core finishes its round before the fifos are emptied
+        self.acquiring = False
+        while self.core1_running:
+            idle()
+        self.measure_timer.deinit()
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+        self.ecg_reset()
+        self.adc_reset()
+        # One-line dump of the profiling counters to the serial console
+        print(self.stats.line(self.adc_fifo, self.isr_jitter))
 
-            # In case the beat fails to be captured due to intereference
-            if self.samples > 500:
-                print("Missed a beat!")
-                self.measure_average = self.measure_avg()
-                # User has pressed the knob
-                if self.measure_average == -1:
-                    return -1.0
-                self.samples = 0
-
-            # Going up, both values are above average
-            #      /
-            # ------------
-            #   /
-            if rising == 0 and value < next_value and self.measure_average < value:
-                rising = 1
-
-            # Going down, next value is smaller and both are below threshold
-            #   \
-            # ------------
-            #    \
-            if (
-                rising == 1
-                and next_value < value
-                and value < int(self.measure_average * 0.95)
-            ):
-                rising = 2
-
-            # Going up, and reaching the average
-            #      /
-            # ------------
-            #   /
-            if rising == 2 and value < next_value and self.measure_average < next_value:
-                # RR INTERVAL MEASUREMENT
-                output = float(self.samples / 250)
-                self.samples = 0
-
-                # Output is an RR interval in whole seconds
-                return output
+    # Empty the fifo and the block that was drained from it
+    def adc_reset(self):
+        self.adc_fifo.clear()
+        self.adc_block_len = 0
+        self.adc_block_pos = 0
 
     # The overall operation for getting an RR interval
     def operate(self):
-        while True:
-            if self.measure_average == 0:
-                self.measure_average = self.measure_avg()
-
-            # Check if ECG can draw
-            self.ecg_draw()
+        if self.dual_core:
+            return self.operate_dual_core()
+        interval = self.detect(True)
+        # User pressed the knob
+        if interval == -1:
+            return -1.0
+        # Return the RR interval in seconds
+        # The sample index counts values at the source rate
+        return float(interval / self.source_rate)
+
+    # Samples to the detector until a beat, returns the interval in samples or -1.
+    # Draw tells whether the ECG is drawn between samples
+    def detect(self, draw):
+        detector = self.detector
+        envelope = self.envelope
+        stats = self.stats
+        ticks_us = time.ticks_us
+        profile = self.PROFILE
+        start = 0
 
-            # Get two points for direction of the slope
+        while True:
+            # Check if ECG can draw, a new point is ready every ECG_DECIMATION values
+            if draw and self.ecg_count == 0:
+                if profile:
+                    start = ticks_us()
+                self.ecg_draw()
+                if profile:
+                    stats.add(ECG_DRAW, start)
+
+            if profile:
+                start = ticks_us()
             value = self.adc_get()
-            next_value = self.adc_get()
+            if profile:
+                stats.add(ADC_GET, start)
 
-            # Upholding the min and max values for ECG
-            self.min_val = value if value < self.min_val else self.min_val
-            self.max_val = value if value > self.max_val else self.max_val
+            # User pressed the knob
+            if value == -1:
+                return -1
 
+            # Every sample goes to the detector, it remembers the slope
+            if profile:
+                start = ticks_us()
+            envelope.update(value)
+            beat = detector.update(value, envelope.baseline, self.sample_index)
+            if profile:
+                stats.add(DETECT, start)
+            if beat != -1:
+                # The first beat only starts the interval
+                if detector.interval > 0:
+                    return detector.interval
+                continue
+
+            # In case the beat fails to be captured due to interference
+            quiet = detector.index - detector.since
+            if detector.last_beat >= 0 and quiet > 2 * self.source_rate:
+                print("Missed a beat!")
+                stats.missed_beats += 1
             # If the program goes three seconds without getting a pulse
-            if self.samples > 750:
+            elif quiet > 3 * self.source_rate:
                 print("Readjusting")
-                self.measure_average = self.measure_avg()
-                self.samples = 0
-
-            # Former value is below latter and it's coming from below
-            if value < next_value and self.measure_average < next_value:
-                # print("Measuring")
-                # Return the RR interval in seconds
-                output = float(self.slope_detection())
-                # User pressed the knob
-                if output == -1.0:
-                    return -1.0
-                return output
-
-    # Beats / intervals added up = seconds per beat times 60
-    def pulse(self, rr_list, limit):
-        """
-        Limit: The amount of interval values to use to normalize the bpm
-        Interval_amount: Length of interval list or "limit" if it goes over it
-        Interval_value: Sum of "limit" or "interval_amount" amount of values
-        """
-        interval_amount = len(rr_list) if len(rr_list) < limit else limit
-        interval_value = 0
-
-        for x in range(interval_amount):
-            interval_value += rr_list[-(1 + x)]
-
-        bpm = int(interval_amount / interval_value * 60)
-
-        # Safeguard for funky values
-        if 240 < bpm:
-            self.measure_average = self.measure_avg()
-            return 0
-
-        output = (self.prev_beat + bpm) / 2
-        self.prev_beat = bpm
-
-        return int(output)
-
-    # Will be changed to display on screen, now only prints .pulse()
+                stats.readjusts += 1
+            else:
+                continue
+
+            # The baseline is already current, only the slope state starts over
+            detector.reset()
+
+    # Second core in dual core mode, runs until stop_sampling() clears .acquiring
+    def acquisition_loop(self):
+        try:
+            while self.acquiring:
+                interval = self.detect(False)
+                # Stopped, or a test capture ran out
+                if interval == -1:
+                    break
+                self.beat_fifo.put(interval)
+        finally:
+            self.core1_running = False
+
+    # First core in dual core mode: waits for the next beat from the second core,
+    # draws the ECG meanwhile and watches the knob
+    def operate_dual_core(self):
+        while True:
+            if self.beat_fifo.has_data():
+                return float(self.beat_fifo.get() / self.source_rate)
+            # User pressed the knob
+            if self.btn_fifo.has_data():
+                self.btn_fifo.get()
+                return -1.0
+            # The second core stopped on its own, e.g. at the end of a test capture
+            if not self.core1_running:
+                return -1.0
+            if self.ecg_fifo.has_data():
+                if self.PROFILE:
+                    start = time.ticks_us()
+                    self.ecg_draw()
+                    self.stats.add(ECG_DRAW, start)
+                else:
+                    self.ecg_draw()
+            else:
+                idle()
+
+    # Displays the BPM on every beat until the knob is pressed
     def heart_rate_detection(self):
         # Empty the screen and put a placeholder text
         self.oled.fill(0)
@@ -278,54 +446,42 @@ class Measure(Screen):
         self.add_text("Press to return", 50, 3)
         self.oled.show()
 
+        self.bpm_estimator.reset()
         # Turn on the Piotimer
-        self.measure_timer = Piotimer(freq=250, callback=self.pio_handler)
-
-        # n latest BPM values, amount is the max length for it
-        restricted_interval_list = []
-        amount = 3
-
-        pulses = 0
-        count = 0
+        self.start_sampling()
 
         while True:
             value = self.operate()
 
             # User pressed the knob, return to main.py
             if value == -1.0:
-                self.ecg_reset()
-                self.measure_timer.deinit()
-                # Empty the fifo
-                while self.adc_fifo.has_data():
-                    self.adc_fifo.get()
+                self.stop_sampling()
                 return
-            else:
-                restricted_interval_list.append(value)
-
-            # Keep the list size in check
-            if len(restricted_interval_list) >= amount:
-                restricted_interval_list.pop(0)
-
-            if len(restricted_interval_list) > 0:
-                pulses += self.pulse(restricted_interval_list, amount)
-                count += 1
 
-            if count >= amount:
-                # Average the collected pulse over set amount
-                display_pulse = int(pulses / amount)
-                count = 0
-                pulses = 0
+            bpm = self.bpm_estimator.update(value)
+            # Safeguard for funky values, the second core owns the detector
+            if bpm == 0:
+                if not self.dual_core:
+                    self.detector.reset()
+                continue
+            self.current_bpm = bpm
 
-                # Redraw a set section of the screen
-                self.oled.fill_rect(0, 33, 128, 15, 0)
-                self.add_text(str(display_pulse) + " BPM", 50, 2)
-                self.oled.show()
+            # Redraw a set section of the screen
+            self.oled.fill_rect(0, 33, 128, 15, 0)
+            self.add_text(str(bpm) + " BPM", 50, 2)
+            self.renderer.mark(0, 33, 127, 47)
+            self.renderer.flush(force=True)
 
-    # Gets RR intervals, add them to the list then returns the list of 29 values
+    # Gets RR intervals, add them to the list then returns the list of 30 values
     def rr_interval_detection(self):
         interval_list = []
+        self.rr_intervals = interval_list
+        self.hrv.reset()
+        self.artifact_filter.reset()
         # Amount of intervals
         countdown = 30
+        # The first value is often yucky
+        first = True
 
         # Empty the screen and put a placeholder text
         self.oled.fill(0)
@@ -334,88 +490,122 @@ class Measure(Screen):
         self.oled.show()
 
         # Turn on the Piotimer
-        self.measure_timer = Piotimer(freq=250, callback=self.pio_handler)
+        self.start_sampling()
 
-        while len(interval_list) <= 30:
+        while len(interval_list) < 30:
             interval = self.operate()
 
             if interval == -1.0:
-                self.ecg_reset()
-                self.measure_timer.deinit()
-                # Empty the fifo
-                while self.adc_fifo.has_data():
-                    self.adc_fifo.get()
+                self.stop_sampling()
                 return []
             else:
                 value = int(interval * 1000)
                 # This means a pulse of over 240
                 if value <= 250:
                     continue
-                interval_list.append(int(interval * 1000))
+                if first:
+                    first = False
+                else:
+                    # A split interval can make more than one
+                    for value in self.artifact_filter.update(value):
+                        if len(interval_list) < 30:
+                            interval_list.append(value)
+                            # The analysis is kept up to date as the intervals come
+                            self.hrv.add(value)
+                    countdown = 30 - len(interval_list)
 
             # Display the progress
             self.oled.fill_rect(0, 33, 128, 15, 0)
             self.add_text(f"{countdown} left", 50, 2)
-            self.oled.show()
-            countdown -= 1
+            self.renderer.mark(0, 33, 127, 47)
+            self.renderer.flush(force=True)
 
-        # The first value is often yucky
-        interval_list.pop(0)
-
-        self.ecg_reset()
-        self.measure_timer.deinit()
-        # Empty the fifo
-        while self.adc_fifo.has_data():
-            self.adc_fifo.get()
+        self.stop_sampling()
 
         print(interval_list)
         return interval_list
 
-    def local_hrv(self, rr_intervals: list):
-        output = {
-            "analysis": {
-                "mean_rr_ms": 0.0,
-                "mean_hr_bpm": 0.0,
-                "rmssd_ms": 0.0,
-                "sdnn_ms": 0.0,
-            }
-        }
-        length = len(rr_intervals)
-
-        # Mean of PP interval values (named rr because Kubios JSON)
-        mean_rr = sum(rr_intervals) / length
-        output["analysis"]["mean_rr_ms"] = mean_rr
-
-        # Mean of beats per minute
-        mean_bpm = 0.0
-        for interval in rr_intervals:
-            mean_bpm += 1 / (interval / 1000) * 60
-        output["analysis"]["mean_hr_bpm"] = mean_bpm / length
-
-        # Square root of mean squared differences between successive PP intervals
-        rmssd = 0.0
-        for x in range(length - 1):
-            rmssd += pow(rr_intervals[x + 1] - rr_intervals[x], 2)
-        output["analysis"]["rmssd_ms"] = math.sqrt(1 / (length - 1) * rmssd)
-
-        # Standard deviation of PP intervals
-        sdnn = 0.0
-        for interval in rr_intervals:
-            sdnn += pow(interval - mean_rr, 2)
-        output["analysis"]["sdnn_ms"] = math.sqrt(1 / length * sdnn)
+    # Keeps measuring until the knob is pressed, HRV of the latest intervals on screen
+    def live_hrv_detection(self):
+        self.live_hrv.reset()
+        self.artifact_filter.reset()
+        # The first value is often yucky
+        first = True
+
+        # Empty the screen and put a placeholder text
+        self.oled.fill(0)
+        self.add_text("Waiting...", 50, 3)
+        self.oled.show()
+
+        # Turn on the Piotimer
+        self.start_sampling()
 
+        while True:
+            interval = self.operate()
+
+            # User pressed the knob, return to main.py
+            if interval == -1.0:
+                self.stop_sampling()
+                return
+
+            value = int(interval * 1000)
+            # This means a pulse of over 240
+            if value <= 250:
+                continue
+            if first:
+                first = False
+                continue
+            for value in self.artifact_filter.update(value):
+                self.live_hrv.add(value)
+
+            # Redraw only the numbers below the ECG
+            self.oled.fill_rect(0, 34, 128, 30, 0)
+            self.oled.text(
+                f"hr {self.live_hrv.mean_hr():.0f} n {self.live_hrv.count}", 0, 36, 1
+            )
+            self.oled.text(f"rmssd: {self.live_hrv.rmssd():.01f}", 0, 46, 1)
+            self.oled.text(f"sdnn: {self.live_hrv.sdnn():.01f}", 0, 56, 1)
+            self.renderer.mark(0, 34, 127, 63)
+            self.renderer.flush(force=True)
+
+    """
+    Local HRV analysis. Without a list, returns the analysis of the intervals
+    of the latest .rr_interval_detection(), the time domain is ready the
+    moment the last interval lands, "artefact" tells the share of replaced
+    intervals. With a list, the intervals are run through a fresh
+    accumulator. "freq_domain" has the same keys as Kubios.
+    """
+
+    def local_hrv(self, rr_intervals: list = None):
+        if rr_intervals is None:
+            output = self.hrv.result()
+            output["analysis"]["artefact"] = self.artifact_filter.percentage()
+            rr_intervals = self.rr_intervals
+        else:
+            accumulator = HrvAccumulator()
+            for interval in rr_intervals:
+                accumulator.add(interval)
+            output = accumulator.result()
+
+        output["analysis"]["freq_domain"] = self.frequency_hrv.analyze(rr_intervals)
         return output
 
     # 0-30 pixels high and 128 wide ECG print
     def ecg_draw(self):
-        while self.ecg_fifo.has_data():
-            value = self.ecg_fifo.get()
+        count = self.ecg_fifo.get_into(self.ecg_block_view)
+        min_val = self.envelope.min_val
+        span = self.envelope.max_val - min_val
+        # Flat signal, nothing to scale
+        if span <= 0:
+            return
+        for x in range(count):
+            value = self.ecg_block[x]
             # Adjust received value for half the screen
-            value = int((value - self.min_val) / (self.max_val - self.min_val) * 30)
+            value = int((value - min_val) / span * 30)
 
             # The calculated value goes beyond boundaries, forget about it
             if not 0 <= value <= 30:
-                return
+                continue
 
             # If the index is at the beginning or at the end
             if self.ecg_x_index == 0 or self.ecg_x_index == 128:
@@ -434,6 +624,8 @@ class Measure(Screen):
                     32 - value,
                     1,
                 )
+            # The point and the two cleared columns after it
+            self.renderer.mark(self.ecg_x_index, 0, self.ecg_x_index + 3, 32)
             # Push the index to the next one and save the y-index
             self.ecg_x_index += 2
             self.ecg_y_index = value
@@ -441,14 +633,41 @@ class Measure(Screen):
             self.oled.vline(self.ecg_x_index, 0, 33, 0)
             self.oled.vline(self.ecg_x_index + 1, 0, 33, 0)
 
-            self.oled.show()
+        # Every point since the last frame goes out in one transfer
+        if self.PROFILE:
+            start = time.ticks_us()
+            if self.renderer.flush():
+                self.stats.add(OLED_SHOW, start)
+        else:
+            self.renderer.flush()
+
+    # Profiling counters of the latest measurement, hidden in the main menu.
+    # The stage rows stay at zero unless PROFILE is on
+    def show_diagnostics(self):
+        print(self.stats.line(self.adc_fifo, self.isr_jitter))
+        self.oled.fill(0)
+        for x in range(len(STAGE_NAMES)):
+            self.oled.text(
+                f"{STAGE_NAMES[x]} {self.stats.calls[x]}", 0, x * 8, 1
+            )
+            self.oled.text(f"{self.stats.average(x)}us", 88, x * 8, 1)
+        self.oled.text(f"dropped: {self.adc_fifo.dropped()}", 0, 32, 1)
+        self.oled.text(
+            f"max: {self.adc_fifo.high_water()}/{self.adc_fifo.size - 1}", 0, 40, 1
+        )
+        self.oled.text(
+            f"miss {self.stats.missed_beats} readj {self.stats.readjusts}", 0, 48, 1
+        )
+        self.oled.text(f"jitter: {self.isr_jitter}us", 0, 56, 1)
+        self.oled.show()
+        # Wait for knob input
+        self.wait_button()
 
     # Reset the ECG plotter and empty the fifo
     def ecg_reset(self):
         self.ecg_x_index = 0
         self.ecg_y_index = 0
-        while self.ecg_fifo.has_data():
-            self.ecg_fifo.get()
+        self.ecg_fifo.clear()
 
 
 # Here we declare everything regarding the WLAN connection
@@ -462,49 +681,68 @@ class Internet(Measure):
 
         self.wlan = network.WLAN(network.STA_IF)
 
-    # Function to connect to WLAN
-    def connect_wlan(self):
-        # Connecting to the WLAN
+        # Connection manager: associates in the background and reconnects with
+        # a growing backoff when the link drops. .poll_wlan() drives it
+        self.WLAN_AT_BOOT = True
+        self.WLAN_POLL_MS = 500
+        self.WLAN_BACKOFF_MIN_MS = 8000
+        self.WLAN_BACKOFF_MAX_MS = 120_000
+        self.wlan_wanted = False
+        self.wlan_backoff = self.WLAN_BACKOFF_MIN_MS
+        self.wlan_retry_at = time.ticks_ms()
+        self.wlan_poll_at = time.ticks_ms()
+
+    # Start associating in the background, returns right away
+    def start_wlan(self):
+        self.wlan_wanted = True
+        status = self.wlan.status()
+        # Joining or already up, leave it be
+        if 0 < status <= network.STAT_GOT_IP:
+            return
+        # Someone is waiting for the link, skip what's left of the backoff
+        self.wlan_backoff = self.WLAN_BACKOFF_MIN_MS
+        self.wlan_retry_at = time.ticks_ms()
+        self.wlan_poll_at = self.wlan_retry_at
+
+    """
+    One step of the connection manager, cheap enough for every round of the
+    main loop. Checks wlan.status() every WLAN_POLL_MS and starts a new
+    connect when the link is down or the attempt failed (status 0 or below)
+    and the backoff has passed. An association in progress is never
+    restarted, the backoff counts from when it gives up. Every failure
+    doubles the backoff.
+    Returns True if the link is up.
+    """
+
+    def poll_wlan(self):
+        if not self.wlan_wanted:
+            return False
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.wlan_poll_at) < 0:
+            return False
+        self.wlan_poll_at = time.ticks_add(now, self.WLAN_POLL_MS)
+
+        status = self.wlan.status()
+        if status == network.STAT_GOT_IP:
+            self.wlan_backoff = self.WLAN_BACKOFF_MIN_MS
+            return True
+        # Still joining or waiting for an address, keep pushing the retry back
+        if status > 0:
+            self.wlan_retry_at = time.ticks_add(now, self.wlan_backoff)
+            return False
+        # Waiting for the backoff after a failure
+        if time.ticks_diff(now, self.wlan_retry_at) < 0:
+            return False
 
         self.wlan.active(True)
         self.wlan.connect(self.SSID, self.PASSWORD)
-
-        # Counting the connect attempts
-        attempt_count = 0
-
-        self.oled.fill(0)
-        # Attempt to connect once per second
-        while not self.wlan.isconnected():
-            self.add_text("Connecting.", 50, 2)
-            self.oled.show()
-            time.sleep(0.25)
-            self.oled.fill(0)
-            self.add_text("Connecting..", 50, 2)
-            self.oled.show()
-            time.sleep(0.25)
-            self.oled.fill(0)
-            self.add_text("Connecting...", 50, 2)
-            self.oled.show()
-            time.sleep(0.25)
-            self.oled.fill(0)
-            attempt_count += 1
-            # Admit defeat, return to main menu
-            if attempt_count >= 10:
-                self.oled.fill(0)
-                self.add_text("Connection", 50, 0)
-                self.add_text("failed!", 50, 1)
-                self.add_text("Returning", 50, 2)
-                self.add_text("to main menu", 50, 3)
-                self.oled.show()
-                return
-
-        # Connection successful
-        self.oled.fill(0)
-        self.add_text("WLAN connected!", 50, 2)
-        self.oled.show()
-        time.sleep(1)
+        self.wlan_retry_at = time.ticks_add(now, self.wlan_backoff)
+        self.wlan_backoff = min(self.wlan_backoff * 2, self.WLAN_BACKOFF_MAX_MS)
+        return False
 
 
+# Kubios Cloud settings, the token cache, the upload queue and the result screen.
+# The API calls are asyncio tasks in kubios_async.AsyncKubios
 class Kubios(Internet):
     def __init__(self):
         # Initialize Internet
@@ -519,55 +757,26 @@ class Kubios(Internet):
             "https://kubioscloud.auth.eu-west-1.amazoncognito.com/oauth2/token"
         )
         self.REDIRECT_URL = "https://analysis.kubioscloud.com/v1/portal/login"
-
-    # Do the API calls and return a json string of the result
-    def calculate_kubios(self, intervals):
-        response = requests.post(
-            url=self.TOKEN_URL,
-            data="grant_type=client_credentials&client_id={}".format(self.CLIENT_ID),
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            auth=(self.CLIENT_ID, self.CLIENT_SECRET),
+        self.ANALYZE_URL = "https://analysis.kubioscloud.com/v2/analytics/analyze"
+        # Access tokens are reused until they're about to expire. The deadline is
+        # a time.time() value and the Pico's clock starts over on every boot, so
+        # a file (e.g. "kubios_token.json") only makes sense with NTP-set time
+        self.TOKEN_FILE = None
+        self.token_cache = TokenCache(self.TOKEN_FILE)
+        # Measurements that couldn't be uploaded yet, sent when the WLAN is up
+        self.UPLOAD_QUEUE_FILE = "upload_queue.txt"
+        # The ones Kubios refused or that failed UPLOAD_ATTEMPTS times
+        self.UPLOAD_REJECTED_FILE = "upload_rejected.txt"
+        self.UPLOAD_ATTEMPTS = 5
+        self.upload_queue = UploadQueue(
+            self.UPLOAD_QUEUE_FILE,
+            attempts=self.UPLOAD_ATTEMPTS,
+            rejected_name=self.UPLOAD_REJECTED_FILE,
         )
 
-        # The API call failed
-        if not response.status_code == 200:
-            self.oled.fill(0)
-            self.add_text("Kubios Failed", 50, 1)
-            self.add_text("Press button to try again", 50, 2)
-            self.oled.show()
-            time.sleep(3)
-            # If the user presses the button during the 3 seconds, reattempt
-            if self.btn_fifo.has_data():
-                response = requests.post(
-                    url=self.TOKEN_URL,
-                    data="grant_type=client_credentials&client_id={}".format(
-                        self.CLIENT_ID
-                    ),
-                    headers={"Content-Type": "application/x-www-form-urlencoded"},
-                    auth=(self.CLIENT_ID, self.CLIENT_SECRET),
-                )
-            else:
-                return ""
-
-        response = response.json()  # Parse JSON response into a python dictionary
-        access_token = response["access_token"]  # Parse access token
-
-        # Create the dataset dictionary HERE
-        dataset = {"type": "RRI", "data": intervals, "analysis": {"type": "readiness"}}
-        # Make the readiness analysis with the given data
-        response = requests.post(
-            url="https://analysis.kubioscloud.com/v2/analytics/analyze",
-            headers={
-                "Authorization": "Bearer {}".format(
-                    access_token
-                ),  # Use access token toaccess your Kubios Cloud analysis session
-                "X-Api-Key": self.APIKEY,
-            },
-            json=dataset,
-        )  # Dataset will be automatically converted to JSON by the urequests library
-
-        response = response.json()
-
+    # Recovery and stress of an analysis with a face, returns it as a json string
+    # once the knob is pressed
+    def show_kubios_result(self, response):
         # Finding the stress and recovery values here
         stress_str = str(round((response["analysis"]["stress_index"])))
         recovery_str = str(round((response["analysis"]["readiness"])))
@@ -580,20 +789,6 @@ class Kubios(Internet):
 
         self.oled.fill(0)
 
-        self.add_text("Connecting.", 50, 2)
-        self.oled.show()
-        time.sleep(0.25)
-        self.oled.fill(0)
-        self.add_text("Connecting..", 50, 2)
-        self.oled.show()
-        time.sleep(0.25)
-        self.oled.fill(0)
-        self.add_text("Connecting...", 50, 2)
-        self.oled.show()
-        time.sleep(0.25)
-        self.oled.fill(0)
-        time.sleep(0.25)
-
         # If the stress index is bigger than 12, then we add a crying, otherwise a smiling face
         if round((response["analysis"]["stress_index"])) >= 12:
             print(round((response["analysis"]["stress_index"])))
@@ -614,8 +809,6 @@ class Kubios(Internet):
 
         self.oled.show()
         # Wait for knob input
-        while self.btn_fifo.empty():
-            time.sleep(0.1)
-        self.btn_fifo.get()
+        self.wait_button()
 
         return json.dumps(response)
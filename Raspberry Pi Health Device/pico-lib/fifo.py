@@ -9,12 +9,26 @@ class Fifo:
     When used from ISR, the ISR should call put() to add data to fifo and
     the main program must read data from fifo by calling get() often enough
     to prevent fifo from getting full.
+    Overflow specifies what put() does when the fifo is full:
+    RAISE raises an exception, which allocates memory - don't use it with hard ISRs.
+    DROP_NEWEST discards the value that was being put.
+    OVERWRITE_OLDEST discards the oldest stored value. Put() then moves the tail,
+    so it is only safe when put() and get() are never called concurrently.
+    Statistics (high_water(), dropped(), total_puts()) can be read without locking.
     """
-    def __init__(self, size, typecode = 'H'):
+    RAISE = 0
+    DROP_NEWEST = 1
+    OVERWRITE_OLDEST = 2
+
+    # Counters wrap here so that they stay small ints and never allocate in an ISR
+    _COUNTER_MASK = 0x3FFFFFFF
+
+    def __init__(self, size, typecode = 'H', overflow = RAISE):
         """Parameters
 
         size (int): Fifo size. The maximum number of items stored is one less than the given size
         typecode (char): Type of data stored in fifo. (Default is 'H' - unsigned short)
+        overflow (int): Fifo.RAISE, Fifo.DROP_NEWEST or Fifo.OVERWRITE_OLDEST. (Default is RAISE)
         """        
         self.data = array.array(typecode)
         for i in range(size):
@@ -22,31 +36,103 @@ class Fifo:
         self.head = 0
         self.tail = 0
         self.size = size
+        self.overflow = overflow
         self.dc = 0
+        self.pc = 0
+        self.hwm = 0
+        self._view = memoryview(self.data)
         
     def put(self, value):
-        """Put one item into the fifo. Raises an exception if the fifo is full."""
-        nh = (self.head + 1) % self.size
+        """Put one item into the fifo. If the fifo is full the overflow policy decides what happens."""
+        self.pc = (self.pc + 1) & self._COUNTER_MASK
+        nh = self.head + 1
+        if nh >= self.size:
+            nh = 0
         if nh != self.tail:
             self.data[self.head] = value
             self.head = nh
+            used = nh - self.tail
+            if used < 0:
+                used += self.size
+            if used > self.hwm:
+                self.hwm = used
         else:
-            self.dc = self.dc + 1
-            raise RuntimeError("Fifo is full - value dropped")
-            
+            self.dc = (self.dc + 1) & self._COUNTER_MASK
+            if self.overflow == self.OVERWRITE_OLDEST:
+                nt = self.tail + 1
+                if nt >= self.size:
+                    nt = 0
+                self.tail = nt
+                self.data[self.head] = value
+                self.head = nh
+            elif self.overflow == self.RAISE:
+                raise RuntimeError("Fifo is full - value dropped")
+
     def get(self):
         """Get one item from the fifo. If the fifo is empty raises an exception and returns the last value."""
         val = self.data[self.tail]
         if self.empty():
             raise RuntimeError("Fifo is empty")
         else:
-            self.tail = (self.tail + 1) % self.size
+            nt = self.tail + 1
+            if nt >= self.size:
+                nt = 0
+            self.tail = nt
         return val
-    
+
+    def get_into(self, buf):
+        """Move all available items into buf, but no more than len(buf) items.
+        Returns the number of items moved. The items are copied with at most two
+        slice copies (the stored data may wrap around the end of the buffer).
+        Buf should be a memoryview of an array with the same typecode as the fifo.
+        Doesn't allocate buffers, so a preallocated buf can be reused on every call.
+        """
+        head = self.head
+        tail = self.tail
+        if head >= tail:
+            first = head - tail
+            second = 0
+        else:
+            first = self.size - tail
+            second = head
+        limit = len(buf)
+        if first >= limit:
+            first = limit
+            second = 0
+        elif first + second > limit:
+            second = limit - first
+        if first:
+            buf[0:first] = self._view[tail:tail + first]
+        if second:
+            buf[first:first + second] = self._view[0:second]
+        tail += first + second
+        if tail >= self.size:
+            tail -= self.size
+        self.tail = tail
+        return first + second
+
+    def clear(self):
+        """Discard all items in the fifo. Must be called from the reading side only."""
+        self.tail = self.head
+
     def dropped(self):
         """Return number of dropped items. A return value that is greater than zero means that fifo is emptied too slowly.""" 
         return self.dc
 
+    def high_water(self):
+        """Return the highest number of items that has been stored at the same time."""
+        return self.hwm
+
+    def total_puts(self):
+        """Return the number of put() calls, including the dropped ones."""
+        return self.pc
+
+    def reset_stats(self):
+        """Zero the statistics counters."""
+        self.dc = 0
+        self.pc = 0
+        self.hwm = 0
+
     def has_data(self):
         """Returns True if there is data in the fifo"""
         return self.head != self.tail
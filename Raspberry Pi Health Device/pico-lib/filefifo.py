@@ -1,57 +1,176 @@
+import array
+import struct
+import time
+
+# Binary capture format: header followed by raw 'H' samples until the end of file.
+# Header: magic, sample rate (samples per second), start tick (ticks_ms), little-endian
+CAPTURE_MAGIC = b"ADC1"
+CAPTURE_HEADER = "<4sHI"
+# Pacing: a reader that falls further behind than this starts over from now
+# instead of getting the whole gap at once (about what a real fifo would hold)
+MAX_GAP_US = 2000000
+
 
 class Filefifo:
     """Mock version of Interrupt safe fifo implementation
     This mock version implements an interface that is identical to
-    the real fifo except for the constructor which takes up to two additional
+    the real fifo except for the constructor which takes up to three additional
     parameters. The mock version is for testing data processing
-    without actually using interrupts. Instead of creating a buffer for data
-    the mock fifo reads data from a file. Method put is a dummy function that
+    without actually using interrupts. Instead of filling a buffer from an ISR
+    the mock fifo parses the whole file once into an array when it is created
+    and serves the data from the array. Method put is a dummy function that
     exists for sake of compatibility.
+    The data can be served as fast as it is read or paced to a sample rate
+    to replay a capture in real time.
+    The file can be text with one integer per line or a binary capture
+    (see CAPTURE_HEADER). Binary captures are read directly into the array.
     """
-    def __init__(self, size, typecode = 'H', name = 'data.txt', repeat = True):
+    def __init__(self, size, typecode = 'H', name = 'data.txt', repeat = True, rate = 0):
         """Parameters
         size (integer): Not used - fifo size in the real implementation
-        typecode(string): Not used - type of stored values in real implementation
-        name (string): Name of the file to read data from. 
+        typecode(string): Type of the values in a text file. Binary captures are always 'H'.
+        name (string): Name of the file to read data from. One integer per line or a binary capture.
         repeat (boolean): End of file behaviour. True means start over from beginning.
-        """        
-        self._file  = open(name)
+        rate (integer): Pacing. 0 means as fast as possible, otherwise samples
+                        become available at this rate (samples per second).
+        """
+        self._data = array.array(typecode)
+        # Sample rate and start tick are known only for binary captures
+        self.sample_rate = 0
+        self.start_tick = 0
+        with open(name, 'rb') as file:
+            header = file.read(struct.calcsize(CAPTURE_HEADER))
+        if header[0:len(CAPTURE_MAGIC)] == CAPTURE_MAGIC:
+            self._read_binary(name, len(header))
+        else:
+            with open(name) as file:
+                for line in file:
+                    line = line.strip()
+                    if len(line) > 0:
+                        self._data.append(int(line))
+        self._view = memoryview(self._data)
         self._repeat = repeat
-        
+        self._pos = 0
+        self._rate = rate
+        # Pacing: samples served since _start, _start moves on once per second
+        self.restart()
+
+    def restart(self):
+        """Restart the pacing clock, e.g. when a measurement starts. The replay
+        goes on from the same position, the next item is due one period later."""
+        self._served = 0
+        self._start = time.ticks_us()
+
+    def _read_binary(self, name, header_size):
+        """Read a binary capture, a block at a time, straight into an 'H' array."""
+        self._data = array.array('H')
+        block = array.array('H', [0] * 128)
+        with open(name, 'rb') as file:
+            _, self.sample_rate, self.start_tick = struct.unpack(
+                CAPTURE_HEADER, file.read(header_size))
+            while True:
+                count = file.readinto(block) // 2
+                if count == 0:
+                    break
+                self._data.extend(block if count == len(block) else block[0:count])
+
+    def _available(self):
+        """Number of items that can be read right now."""
+        if self._repeat:
+            # With repeat the data never runs out, only pacing limits reading
+            count = 0x3FFFFFFF if len(self._data) > 0 else 0
+        else:
+            count = len(self._data) - self._pos
+        if self._rate > 0 and count > 0:
+            elapsed = time.ticks_diff(time.ticks_us(), self._start)
+            # Not read for a long time, or so long that ticks_diff wrapped
+            if elapsed < 0 or elapsed > MAX_GAP_US:
+                self.restart()
+                elapsed = 0
+            # Move the start once per second so that ticks_diff never wraps
+            while elapsed >= 1000000:
+                self._start = time.ticks_add(self._start, 1000000)
+                self._served -= self._rate
+                elapsed -= 1000000
+            due = elapsed * self._rate // 1000000 - self._served
+            if due < count:
+                count = due if due > 0 else 0
+        return count
+
     def put(self, value):
         """Put one item into the fifo. In the mock this function does nothing since data comes from a file."""
         pass
 
     def get(self):
-        """Get one item from the fifo. If repeat is set to False and file ends raises an exception and returns the last value."""
-        value = -1
-        fail = False
-        str = self._file.readline()
-        if len(str) > 0:
-            value = int(str)
-        else:
-            if self._repeat:
-                self._file.seek(0)
-                str = self._file.readline()
-                if len(str) > 0:
-                    value = int(str)
-                else:
-                    fail = True
-            else:
-                fail = True
-        if fail:
+        """Get one item from the fifo. If repeat is set to False and file ends raises an exception.
+        When paced, raises an exception if the next item isn't due yet."""
+        if self.eof():
             raise RuntimeError("Out of data")
-
+        if self._available() == 0:
+            raise RuntimeError("Fifo is empty")
+        value = self._data[self._pos]
+        self._pos += 1
+        if self._pos >= len(self._data) and self._repeat:
+            self._pos = 0
+        self._served += 1
         return value
-    
+
+    def get_into(self, buf):
+        """Move available items into buf, but no more than len(buf) items.
+        Returns the number of items moved. Buf should be a memoryview of an array
+        with the same typecode as the fifo.
+        """
+        count = self._available()
+        if count > len(buf):
+            count = len(buf)
+        done = 0
+        while done < count:
+            chunk = count - done
+            if chunk > len(self._data) - self._pos:
+                chunk = len(self._data) - self._pos
+            buf[done:done + chunk] = self._view[self._pos:self._pos + chunk]
+            done += chunk
+            self._pos += chunk
+            if self._pos >= len(self._data) and self._repeat:
+                self._pos = 0
+        self._served += count
+        return count
+
+    def clear(self):
+        """Discard all items that are available right now."""
+        count = self._available()
+        if self._repeat:
+            if count < 0x3FFFFFFF:
+                self._pos = (self._pos + count) % len(self._data)
+                self._served += count
+        else:
+            self._pos += count
+            self._served += count
+
+    def eof(self):
+        """Returns True if repeat is set to False and all data has been read."""
+        return not self._repeat and self._pos >= len(self._data)
+
     def dropped(self):
         """Return number of dropped items. Mock always returns zero."""
         return 0
-       
+
+    def high_water(self):
+        """Return the highest number of items stored at the same time. Mock always returns zero."""
+        return 0
+
+    def total_puts(self):
+        """Return the number of put() calls. Mock always returns zero."""
+        return 0
+
+    def reset_stats(self):
+        """Zero the statistics counters. Mock does nothing."""
+        pass
+
     def has_data(self):
-        """Returns True if there is data in the fifo. Mock always returns True."""
-        return True
-                
+        """Returns True if there is data in the fifo."""
+        return self._available() > 0
+
     def empty(self):
-        """Returns True if the fifo is empty. Mock always returns False."""
-        return False
+        """Returns True if the fifo is empty."""
+        return self._available() == 0
@@ -0,0 +1,90 @@
+import time
+
+# SSD1306 commands for the window that the following data is written to
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+
+# Sends only the changed part of the framebuffer to the OLED, and no more often
+# than the frame rate allows. Drawing goes to the framebuffer as before, the
+# drawn area is marked dirty and flush() pushes it out
+class Renderer:
+    def __init__(self, oled, frame_rate=20) -> None:
+        """
+        Oled: SSD1306_I2C, its buffer is sent page by page (8 pixel rows each)
+        Frame_rate: Most flushes per second, flush(force=True) ignores it
+        Dirty area: Columns x0..x1 and pages page0..page1, x1 < x0 means clean
+        """
+        self.oled = oled
+        self.width = oled.width
+        self.pages = oled.height // 8
+        self.buffer_view = memoryview(oled.buffer)
+        self.frame_us = 1_000_000 // frame_rate
+        self.last_flush = time.ticks_us()
+        self.flushes = 0
+        self.clean()
+
+    def clean(self):
+        self.x0 = self.width
+        self.x1 = -1
+        self.page0 = self.pages
+        self.page1 = -1
+
+    # Mark a rectangle as changed, corners are inclusive and get clipped to the screen
+    def mark(self, x0, y0, x1, y1):
+        if x0 < 0:
+            x0 = 0
+        if x1 >= self.width:
+            x1 = self.width - 1
+        if y0 < 0:
+            y0 = 0
+        if x1 < x0 or y1 < y0:
+            return
+        page0 = y0 >> 3
+        page1 = y1 >> 3
+        if page1 >= self.pages:
+            page1 = self.pages - 1
+        if x0 < self.x0:
+            self.x0 = x0
+        if x1 > self.x1:
+            self.x1 = x1
+        if page0 < self.page0:
+            self.page0 = page0
+        if page1 > self.page1:
+            self.page1 = page1
+
+    # The whole screen changed, e.g. after fill()
+    def mark_all(self):
+        self.x0 = 0
+        self.x1 = self.width - 1
+        self.page0 = 0
+        self.page1 = self.pages - 1
+
+    # Send the dirty area if there is one and a frame is due, returns True if sent
+    def flush(self, force=False):
+        if self.x1 < self.x0:
+            return False
+        now = time.ticks_us()
+        if not force and time.ticks_diff(now, self.last_flush) < self.frame_us:
+            return False
+        self.last_flush = now
+
+        oled = self.oled
+        oled.write_cmd(SET_COL_ADDR)
+        oled.write_cmd(self.x0)
+        oled.write_cmd(self.x1)
+        oled.write_cmd(SET_PAGE_ADDR)
+        oled.write_cmd(self.page0)
+        oled.write_cmd(self.page1)
+        # The display fills the window a page at a time, one row slice per page
+        for page in range(self.page0, self.page1 + 1):
+            start = page * self.width
+            oled.write_data(self.buffer_view[start + self.x0 : start + self.x1 + 1])
+        self.flushes += 1
+        self.clean()
+        return True
+
+    # Full-screen show() through the renderer, so that it stays in sync
+    def show(self):
+        self.mark_all()
+        self.flush(force=True)
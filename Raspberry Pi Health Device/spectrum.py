@@ -0,0 +1,174 @@
+import array
+import math
+
+# Frequency bands in Hz, the same ones Kubios uses
+VLF_BAND = (0.0, 0.04)
+LF_BAND = (0.04, 0.15)
+HF_BAND = (0.15, 0.4)
+
+
+# Frequency-domain HRV on the device. The RR series is resampled to an even grid,
+# Hann windowed and run through an FFT. The twiddle and window tables are
+# computed once, an analysis doesn't call sin or cos.
+class FrequencyHrv:
+    def __init__(self, size=256, rate=4) -> None:
+        """
+        Size: FFT length, a power of two. Longer series are cut after size samples
+        Rate: Resampling rate in Hz, size / rate seconds fit in one analysis
+        Cos_table, sin_table: A full circle in size steps, for twiddles and the window
+        """
+        self.size = size
+        self.rate = rate
+        self.cos_table = array.array("f", [0.0] * size)
+        self.sin_table = array.array("f", [0.0] * size)
+        for k in range(size):
+            self.cos_table[k] = math.cos(2 * math.pi * k / size)
+            self.sin_table[k] = math.sin(2 * math.pi * k / size)
+        # Real and imaginary parts, zero padded past the resampled series
+        self.real = array.array("f", [0.0] * size)
+        self.imag = array.array("f", [0.0] * size)
+
+    # Resample the intervals to self.rate Hz into self.real, returns the sample count
+    def resample(self, rr_intervals):
+        step = 1000 / self.rate
+        count = 0
+        # Time (ms) of the current and the next interval, value is the interval itself
+        time_now = 0.0
+        index = 0
+        time_next = float(rr_intervals[1])
+        t = 0.0
+        last = len(rr_intervals) - 1
+        while count < self.size:
+            while time_next < t:
+                index += 1
+                if index >= last:
+                    return count
+                time_now = time_next
+                time_next += rr_intervals[index + 1]
+            # Linear interpolation between the two intervals
+            weight = (t - time_now) / (time_next - time_now)
+            self.real[count] = rr_intervals[index] + weight * (
+                rr_intervals[index + 1] - rr_intervals[index]
+            )
+            count += 1
+            t += step
+        return count
+
+    # Remove the mean and apply a Hann window over the count samples, zero the rest
+    def window(self, count):
+        mean = 0.0
+        for n in range(count):
+            mean += self.real[n]
+        mean /= count
+
+        size = self.size
+        scale = size / (count - 1)
+        power = 0.0
+        for n in range(size):
+            if n < count:
+                # Hann window from the cos table, the nearest step is close enough
+                w = 0.5 - 0.5 * self.cos_table[int(n * scale + 0.5) % size]
+                self.real[n] = (self.real[n] - mean) * w
+                power += w * w
+            else:
+                self.real[n] = 0.0
+            self.imag[n] = 0.0
+        return power
+
+    # In-place iterative radix-2 FFT of self.real and self.imag
+    def fft(self):
+        size = self.size
+        real = self.real
+        imag = self.imag
+
+        # Bit reversed order
+        j = 0
+        for i in range(1, size):
+            bit = size >> 1
+            while j & bit:
+                j ^= bit
+                bit >>= 1
+            j |= bit
+            if i < j:
+                real[i], real[j] = real[j], real[i]
+                imag[i], imag[j] = imag[j], imag[i]
+
+        length = 2
+        while length <= size:
+            half = length >> 1
+            stride = size // length
+            for start in range(0, size, length):
+                k = 0
+                for n in range(start, start + half):
+                    c = self.cos_table[k]
+                    s = self.sin_table[k]
+                    m = n + half
+                    re = real[m] * c + imag[m] * s
+                    im = imag[m] * c - real[m] * s
+                    real[m] = real[n] - re
+                    imag[m] = imag[n] - im
+                    real[n] += re
+                    imag[n] += im
+                    k += stride
+            length <<= 1
+
+    # Same keys as the "freq_domain" of a Kubios analysis, powers in ms^2
+    def analyze(self, rr_intervals):
+        output = {
+            "VLF_peak": 0.0,
+            "VLF_power": 0.0,
+            "VLF_power_prc": 0.0,
+            "LF_peak": 0.0,
+            "LF_power": 0.0,
+            "LF_power_nu": 0.0,
+            "LF_power_prc": 0.0,
+            "HF_peak": 0.0,
+            "HF_power": 0.0,
+            "HF_power_nu": 0.0,
+            "HF_power_prc": 0.0,
+            "LF_HF_power": 0.0,
+            "tot_power": 0.0,
+        }
+        if len(rr_intervals) < 3:
+            return output
+        count = self.resample(rr_intervals)
+        if count < 2:
+            return output
+        window_power = self.window(count)
+        self.fft()
+
+        # One-sided power spectral density, integrated over each band
+        resolution = self.rate / self.size
+        scale = 2 / (self.rate * window_power) * resolution
+        bands = (("VLF", VLF_BAND), ("LF", LF_BAND), ("HF", HF_BAND))
+        for name, (low, high) in bands:
+            power = 0.0
+            peak = 0.0
+            peak_power = -1.0
+            first = max(1, int(low / resolution))
+            for k in range(first, self.size // 2):
+                frequency = k * resolution
+                if frequency >= high:
+                    break
+                if frequency < low:
+                    continue
+                density = self.real[k] * self.real[k] + self.imag[k] * self.imag[k]
+                power += density
+                if density > peak_power:
+                    peak_power = density
+                    peak = frequency
+            output[name + "_power"] = power * scale
+            output[name + "_peak"] = peak
+
+        total = output["VLF_power"] + output["LF_power"] + output["HF_power"]
+        output["tot_power"] = total
+        if total > 0:
+            for name, _ in bands:
+                output[name + "_power_prc"] = output[name + "_power"] / total * 100
+        lf_hf = output["LF_power"] + output["HF_power"]
+        if lf_hf > 0:
+            output["LF_power_nu"] = output["LF_power"] / lf_hf * 100
+            output["HF_power_nu"] = output["HF_power"] / lf_hf * 100
+        if output["HF_power"] > 0:
+            output["LF_HF_power"] = output["LF_power"] / output["HF_power"]
+        return output
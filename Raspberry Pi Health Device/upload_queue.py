@@ -0,0 +1,96 @@
+import json
+
+
+# RR datasets waiting for a Kubios upload, one json list per line in a file so
+# that they survive a reboot. When the queue is full the oldest one is dropped.
+# A dataset that can't be uploaded is set aside so that it doesn't block the rest
+class UploadQueue:
+    def __init__(self, name, size=10, attempts=5, rejected_name=None) -> None:
+        """
+        Name: File the queue is kept in
+        Size: Most datasets kept, 10 * 30 intervals is a few kilobytes of flash
+        Attempts: Failed uploads of the oldest dataset before it's set aside
+        Rejected_name: File the datasets that were set aside go to, None drops them
+        Items: The queue in memory, oldest first
+        Saved: False if the file couldn't be written and is behind the memory
+        Failures: Failed uploads of the oldest dataset since this boot
+        """
+        self.name = name
+        self.size = size
+        self.attempts = attempts
+        self.rejected_name = rejected_name
+        self.items = []
+        self.saved = True
+        self.failures = 0
+        self.load()
+
+    def load(self):
+        self.items = []
+        try:
+            with open(self.name) as file:
+                for line in file:
+                    line = line.strip()
+                    if len(line) > 0:
+                        self.items.append(json.loads(line))
+        except (OSError, ValueError):
+            # No queue yet, or a line that was cut short by a power loss
+            pass
+
+    # Returns False if the flash is full or read-only, the queue is still in memory
+    def save(self):
+        try:
+            with open(self.name, "w") as file:
+                for item in self.items:
+                    file.write(json.dumps(item) + "\n")
+            self.saved = True
+        except OSError:
+            print("Upload queue not saved to flash")
+            self.saved = False
+        return self.saved
+
+    def pending(self):
+        return len(self.items)
+
+    # Add a dataset, usually only appended to the file. Returns False if it's
+    # only in memory, see .save()
+    def add(self, intervals):
+        self.items.append(intervals)
+        if len(self.items) > self.size:
+            self.items.pop(0)
+        # A file that is behind the memory is written over
+        elif self.saved:
+            try:
+                with open(self.name, "a") as file:
+                    file.write(json.dumps(intervals) + "\n")
+                return True
+            except OSError:
+                pass
+        return self.save()
+
+    # The oldest dataset, it stays queued until pop()
+    def peek(self):
+        return self.items[0]
+
+    def pop(self):
+        item = self.items.pop(0)
+        self.failures = 0
+        self.save()
+        return item
+
+    # The oldest dataset failed to upload, it's set aside after enough attempts
+    def fail(self):
+        self.failures += 1
+        if self.failures >= self.attempts:
+            self.reject()
+
+    # Set the oldest dataset aside, sending it again won't help
+    def reject(self):
+        item = self.pop()
+        print("Upload set aside")
+        if self.rejected_name:
+            try:
+                with open(self.rejected_name, "a") as file:
+                    file.write(json.dumps(item) + "\n")
+            except OSError:
+                pass
+        return item